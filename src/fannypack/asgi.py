@@ -0,0 +1,18 @@
+"""
+ASGI config for fannypack project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+serve it with any ASGI server, e.g. ``uvicorn fannypack.asgi:application``.
+Requests are handled by Django on a pool of ``ASGI_THREADS`` threads.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+from payments.asgi import ASGIHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fannypack.settings")
+
+application = ASGIHandler(get_wsgi_application(), threads=settings.ASGI_THREADS)
@@ -53,7 +53,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'graphql_jwt.middleware.JSONWebTokenMiddleware',
+    'payments.middleware.JSONWebTokenMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -78,6 +78,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'fannypack.wsgi.application'
 
+# Threads handling requests when served through fannypack/asgi.py
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+# Threads resolving root fields of read-only GraphQL operations concurrently, 0 resolves them in order
+GRAPHQL_EXECUTOR_THREADS = int(os.environ.get('GRAPHQL_EXECUTOR_THREADS', 0))
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
@@ -92,6 +97,15 @@ DATABASES = {
     }
 }
 
+# Read-only GraphQL operations are served by these replicas, comma separated hosts
+for index, host in enumerate(h for h in os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',') if h):
+    DATABASES['replica{}'.format(index)] = dict(DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'})
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['payments.routers.ReplicaRouter']
+# Seconds the reads of a user stay on the primary after their mutation
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -138,13 +152,81 @@ MEDIA_ROOT = '/code/media/'
 GRAPHENE = {
     'SCHEMA': 'fannypack.schema.schema',
     'MIDDLEWARE': [
-            'graphql_jwt.middleware.JSONWebTokenMiddleware',
+            'payments.middleware.JSONWebTokenMiddleware',
+            'payments.instrumentation.TimingMiddleware',
     ],
 }
 
 AUTHENTICATION_BACKENDS = [
-    'graphql_jwt.backends.JSONWebTokenBackend',
+    'payments.backends.JSONWebTokenBackend',
     'django.contrib.auth.backends.ModelBackend',
 ]
 
+# Seconds a verified token stays mapped to its user snapshot, 0 disables the cache
+JWT_USER_CACHE_TIMEOUT = int(os.environ.get('JWT_USER_CACHE_TIMEOUT', 0))
+
 CORS_ORIGIN_ALLOW_ALL = True
+
+# The response cache, the JWT user cache and replica pinning are shared by all workers through
+# the default cache, they require a shared backend such as memcached, see `payments.checks`
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Seconds a read-only GraphQL response stays cached, 0 disables the cache
+GRAPHQL_RESPONSE_CACHE_TIMEOUT = int(os.environ.get('GRAPHQL_RESPONSE_CACHE_TIMEOUT', 0))
+
+# Seconds the result of a mutation stays stored under its idempotency key, 0 disables replays.
+# Expired keys are deleted by the purge_idempotency_keys command
+IDEMPOTENCY_KEY_TIMEOUT = int(os.environ.get('IDEMPOTENCY_KEY_TIMEOUT', 86400))
+
+# Admin changelists of tables estimated above this many rows show the PostgreSQL planner estimate
+# instead of running COUNT(*)
+ADMIN_EXACT_COUNT_LIMIT = int(os.environ.get('ADMIN_EXACT_COUNT_LIMIT', 10000))
+
+# Admin change views of rooms with more members than this skip the balance summary, it settles the whole matrix
+ADMIN_BALANCE_SUMMARY_MEMBERS = int(os.environ.get('ADMIN_BALANCE_SUMMARY_MEMBERS', 200))
+
+# Share of GraphQL requests traced for the /metrics/ endpoint, between 0 and 1
+GRAPHQL_METRICS_SAMPLE_RATE = float(os.environ.get('GRAPHQL_METRICS_SAMPLE_RATE', 0))
+# Operation names reported as the `operation` label, other named operations are reported as `other`
+GRAPHQL_METRICS_OPERATIONS = os.environ.get(
+    'GRAPHQL_METRICS_OPERATIONS', 'TokenAuth,Room,GetPayments,MakePayment,AddUserToRoom').split(',')
+# Bearer token of the /metrics/ scraper, staff users are allowed without it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Attach the trace of sampled requests to the response `extensions`
+GRAPHQL_METRICS_EXTENSIONS = os.environ.get('GRAPHQL_METRICS_EXTENSIONS', 'False') == 'True'
+
+# Smallest GraphQL response body in bytes compressed with brotli or gzip, 0 disables compression
+GRAPHQL_COMPRESSION_MIN_BYTES = int(os.environ.get('GRAPHQL_COMPRESSION_MIN_BYTES', 1024))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'payments': {
+            'handlers': ['console'],
+            'level': os.environ.get('PAYMENTS_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Settlement engine traces: share of `Optimization.run` calls traced, level of the traces
+# and ids of rooms whose full matrices are dumped as well.
+# Traces go to the `payments.engine` logger, they are dropped unless ENGINE_TRACE_LEVEL is at least
+# PAYMENTS_LOG_LEVEL above
+ENGINE_TRACE_SAMPLE_RATE = float(os.environ.get('ENGINE_TRACE_SAMPLE_RATE', 0))
+ENGINE_TRACE_LEVEL = os.environ.get('ENGINE_TRACE_LEVEL', 'INFO')
+ENGINE_TRACE_MATRIX_ROOMS = [r for r in os.environ.get('ENGINE_TRACE_MATRIX_ROOMS', '').split(',') if r]
+
+# Import the settlement engine (pandas, NumPy) at startup instead of on the first payment,
+# meant for workers serving mutations
+PRELOAD_ENGINE = os.environ.get('PRELOAD_ENGINE', 'False') == 'True'
@@ -1,8 +1,208 @@
-from django.contrib import admin
+import io
+import json
+
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html, format_html_join
 
 # Register your models here.
 from payments.models import Room, Payment, User
+from payments.utils import engine, importer, responseCache
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+        On PostgreSQL the row count of an unfiltered changelist comes from the query planner, an exact
+        COUNT(*) only runs when the estimate is below `ADMIN_EXACT_COUNT_LIMIT` rows.
+        Filtered and searched changelists are counted exactly, the planner is far off for them.
+    """
+
+    @cached_property
+    def count(self):
+        connection = connections[self.object_list.db]
+        if connection.vendor == 'postgresql' and not self.object_list.query.where:
+            estimate = self.estimate(connection)
+            if estimate >= settings.ADMIN_EXACT_COUNT_LIMIT:
+                return estimate
+        return super().count
+
+    def estimate(self, connection):
+        sql, params = self.object_list.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class IndexedSearchMixin:
+    """
+        Search with the `search_lookups` of indexed columns only, instead of the `icontains` scans
+        of `search_fields`. Terms not valid for a field (e.g. a name searched as UUID) skip its lookup.
+    """
+    search_lookups = ()
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        condition = Q()
+        for lookup in self.search_lookups:
+            if '__' not in lookup:
+                try:
+                    self.model._meta.get_field(lookup).to_python(term)
+                except ValidationError:
+                    continue
+            condition |= Q(**{lookup: term})
+        if not condition:
+            return queryset.none(), False
+        return queryset.filter(condition), False
+
+
+class ImportForm(forms.Form):
+    users = forms.FileField(required=False, help_text='columns: ' + ', '.join(importer.FIELDS['users']))
+    rooms = forms.FileField(required=False, help_text='columns: ' + ', '.join(importer.FIELDS['rooms']))
+    members = forms.FileField(required=False, help_text='columns: ' + ', '.join(importer.FIELDS['members']))
+    payments = forms.FileField(required=False, help_text='columns: ' + ', '.join(importer.FIELDS['payments']))
+
+
+class InvalidatingMixin:
+    """
+        Invalidate cached GraphQL responses showing objects changed or deleted through the admin,
+        admins of models shown in responses override `invalidate`
+    """
+
+    def invalidate(self, obj):
+        pass
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.invalidate(obj)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.invalidate(obj)
+
+    def delete_queryset(self, request, queryset):
+        objects = list(queryset)
+        super().delete_queryset(request, queryset)
+        for obj in objects:
+            self.invalidate(obj)
+
+
+class UserAdmin(InvalidatingMixin, IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('username', 'email', 'balance', 'is_staff')
+    search_fields = ('username',)
+    search_lookups = ('username__startswith',)
+    raw_id_fields = ('rooms',)
+
+    def invalidate(self, user):
+        User.balances_changed([user.pk])
+
+
+class RoomAdmin(InvalidatingMixin, IndexedSearchMixin, admin.ModelAdmin):
+    change_list_template = 'admin/payments/room/change_list.html'
+    list_display = ('name', 'total_balance', 'biggest_pledger', 'payments')
+    search_fields = ('id', 'name')
+    search_lookups = ('id', 'name__startswith')
+    # derived from the payments, changed by making or deleting payments only
+    readonly_fields = ('total_balance', 'biggest_pledger', 'balance_summary')
+    exclude = ('matrix',)
+
+    def get_queryset(self, request):
+        # the matrix is loaded on access, only by the balance summary of the change view
+        return super().get_queryset(request).defer('matrix')
+
+    def invalidate(self, room):
+        responseCache.invalidate(room.id)
+
+    def payments(self, room):
+        url = reverse('admin:payments_payment_changelist')
+        return format_html('<a href="{}?room__id__exact={}">Payments</a>', url, room.id)
+
+    def balance_summary(self, room):
+        """
+            Balances and transfers of the settled room matrix, for rooms of up to `ADMIN_BALANCE_SUMMARY_MEMBERS`
+            members, settling bigger rooms would hold up the change view
+        """
+        # statistics have a row per user of the matrix
+        members = room.statistics.count()
+        if members > settings.ADMIN_BALANCE_SUMMARY_MEMBERS:
+            return 'Not shown for rooms of more than {} members, this room has {}'.format(
+                settings.ADMIN_BALANCE_SUMMARY_MEMBERS, members)
+        op = engine.Optimization(room_id=room.id)
+        op.load_from_json(room.matrix)
+        names = User.usernames(op.matrix.index)
+        balances = sorted(op.get_balances().items(), key=lambda item: item[1])
+        balances = format_html_join('', '<tr><td>{}</td><td>{}</td></tr>', (
+            (names[user], '{:.2f}'.format(balance)) for user, balance in balances))
+        transfers = format_html_join('', '<tr><td>{} &rarr; {}</td><td>{}</td></tr>', (
+            (names[debtor], names[creditor], '{:.2f}'.format(amount))
+            for debtor, creditor, amount in op.get_transfers()))
+        return format_html('<table><tr><th>Balance</th><th></th></tr>{}'
+                           '<tr><th>Transfers</th><th></th></tr>{}</table>', balances, transfers)
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='payments_room_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """
+            Upload CSV or NDJSON files for `payments.utils.importer`, read line by line from the upload
+        """
+        if not self.has_add_permission(request):
+            return redirect('admin:payments_room_changelist')
+
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            records = {
+                kind: importer.read_records(io.TextIOWrapper(upload.file, encoding='utf-8', newline=''), upload.name)
+                for kind, upload in form.cleaned_data.items() if kind in importer.FIELDS and upload
+            }
+            try:
+                # web workers never fork, large imports go through the `import_data` command
+                counts = importer.run(**records)
+            except Exception as e:
+                messages.error(request, 'Import failed: {}'.format(e))
+            else:
+                messages.success(request, 'Imported ' + ', '.join(
+                    '{} {}'.format(count, name) for name, count in sorted(counts.items())))
+                return redirect('admin:payments_room_changelist')
+
+        context = dict(self.admin_site.each_context(request), form=form, opts=self.model._meta, title='Import')
+        return TemplateResponse(request, 'admin/payments/room/import.html', context)
+
+
+class PaymentAdmin(InvalidatingMixin, IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'amount', 'date', 'drawee', 'pledger', 'room')
+    list_select_related = ('drawee', 'pledger', 'room')
+    list_filter = (('date', admin.DateFieldListFilter),)
+    ordering = ('-date',)
+    search_fields = ('id', 'drawee__username', 'pledger__username')
+    search_lookups = ('id', 'drawee__username', 'pledger__username')
+    raw_id_fields = ('drawee', 'pledger', 'room')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('room__matrix')
+
+    def invalidate(self, payment):
+        responseCache.invalidate(payment.room_id)
+
 
-admin.site.register(User)
-admin.site.register(Room)
-admin.site.register(Payment)
+admin.site.register(User, UserAdmin)
+admin.site.register(Room, RoomAdmin)
+admin.site.register(Payment, PaymentAdmin)
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PaymentsConfig(AppConfig):
     name = 'payments'
+
+    def ready(self):
+        from payments import checks  # noqa: registers the checks
+        if settings.PRELOAD_ENGINE:
+            from payments.utils import engine
+            engine.load()
@@ -0,0 +1,165 @@
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+
+class Disconnected(Exception):
+    """
+        Raised in the application thread when the client went away, stops producing the response
+    """
+
+
+class ASGIHandler:
+    """
+        ASGI application serving a WSGI application from a bounded thread pool.
+        The event loop only holds connections and moves bytes, so idle clients cost no thread;
+        Django, the ORM and the settlement engine run on at most `threads` threads.
+    """
+
+    def __init__(self, wsgi_application, threads):
+        self.wsgi_application = wsgi_application
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope {}'.format(scope['type']))
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_event_loop()
+        # bounded, so a slow client pauses the thread producing its response
+        messages = asyncio.Queue(maxsize=8)
+        disconnected = threading.Event()
+
+        def put(message):
+            if disconnected.is_set():
+                raise Disconnected()
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        # the whole request runs on one thread, Django closes its database connections when it finishes
+        task = loop.run_in_executor(self.pool, self.run, scope, bytes(body), put)
+        disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+        completed = False
+        try:
+            while not completed:
+                getter = asyncio.ensure_future(messages.get())
+                await asyncio.wait([getter, disconnect], return_when=asyncio.FIRST_COMPLETED)
+                if disconnect.done():
+                    getter.cancel()
+                    break
+                message = getter.result()
+                await send(message)
+                completed = message['type'] == 'http.response.body' and not message.get('more_body')
+        finally:
+            disconnect.cancel()
+            if not completed:
+                # the client is gone or `send` failed, the application thread stops at its next `put`
+                disconnected.set()
+                await self.drain(messages, task)
+                # retrieved, `send` failures propagate instead
+                task.exception()
+        try:
+            await task
+        except Disconnected:
+            pass
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    async def drain(messages, task):
+        """
+            Discard messages until the application thread finishes, so it is never left waiting for room in the queue
+        """
+        while not task.done():
+            getter = asyncio.ensure_future(messages.get())
+            await asyncio.wait([getter, task], return_when=asyncio.FIRST_COMPLETED)
+            getter.cancel()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, scope, body, put):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        def send_start():
+            if not response.get('sent'):
+                put({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                response['sent'] = True
+
+        try:
+            result = self.wsgi_application(self.environ(scope, body), start_response)
+            try:
+                for chunk in result:
+                    send_start()
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                # also when the client disconnected, releases what the response holds
+                if hasattr(result, 'close'):
+                    result.close()
+            send_start()
+        except Disconnected:
+            raise
+        except Exception:
+            if not response.get('sent'):
+                response.update(status=500, headers=[])
+                send_start()
+            put({'type': 'http.response.body', 'body': b''})
+            raise
+        put({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        # the body is read in full, chunked requests carry no length header
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
@@ -0,0 +1,139 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from graphql_jwt.backends import JSONWebTokenBackend as BaseJSONWebTokenBackend
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.utils import get_credentials, get_payload
+
+TOKEN_KEY = 'jwt-user:{}'
+GENERATION_KEY = 'jwt-user-generation:{}'
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _token_key(token):
+    return TOKEN_KEY.format(_token_hash(token))
+
+
+def _generation_key(user_id):
+    return GENERATION_KEY.format(user_id)
+
+
+def get_cached_user(token):
+    key = _token_key(token)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        return None
+
+    user_id, generation, field_names, values = snapshot
+    if cache.get(_generation_key(user_id), 0) != generation:
+        cache.delete(key)
+        return None
+
+    return get_user_model().from_db('default', field_names, values)
+
+
+def get_generation(user_id):
+    return cache.get(_generation_key(user_id), 0)
+
+
+def cache_user(token, user, generation):
+    """
+        Store a snapshot of `user` valid while the generation of the user is `generation`,
+        read before the user row the snapshot is taken from
+    """
+    fields = [f for f in user._meta.concrete_fields if f.attname != 'password']
+    snapshot = (
+        user.pk,
+        generation,
+        [f.attname for f in fields],
+        [getattr(user, f.attname) for f in fields],
+    )
+    cache.set(_token_key(token), snapshot, settings.JWT_USER_CACHE_TIMEOUT)
+
+
+def forget_token(token):
+    cache.delete(_token_key(token))
+
+
+def _bump_generation(user_id):
+    key = _generation_key(user_id)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def forget_user(user_id):
+    """
+        Invalidate every cached snapshot of the user, called whenever the user row changes.
+        Bumped immediately and once more after commit, a snapshot taken of the row before the commit
+        is outdated either way.
+    """
+    _bump_generation(user_id)
+    transaction.on_commit(partial(_bump_generation, user_id))
+
+
+def is_revoked(token):
+    # the models import this module
+    from payments.models import RevokedToken
+    return RevokedToken.objects.filter(token=_token_hash(token)).exists()
+
+
+def revoke_token(token):
+    """
+        Reject `token` from now on. Revocations are kept until the token expires,
+        for good when tokens are not verified to expire.
+    """
+    from payments.models import RevokedToken
+
+    expires = None
+    if jwt_settings.JWT_VERIFY_EXPIRATION:
+        expires = datetime.fromtimestamp(get_payload(token)['exp'], timezone.utc) + timedelta(
+            seconds=jwt_settings.JWT_LEEWAY)
+        RevokedToken.objects.filter(expires__lt=timezone.now()).delete()
+    RevokedToken.objects.get_or_create(token=_token_hash(token), defaults={'expires': expires})
+    forget_token(token)
+    # a request authenticated meanwhile may have stored the snapshot again
+    transaction.on_commit(partial(forget_token, token))
+
+
+class JSONWebTokenBackend(BaseJSONWebTokenBackend):
+    """
+        JWT backend which keeps verified tokens mapped to a snapshot of their user for
+        `JWT_USER_CACHE_TIMEOUT` seconds, so authenticating a known token costs no query.
+        Tokens revoked by the logout mutation are rejected.
+    """
+
+    def authenticate(self, request=None, **kwargs):
+        if request is None:
+            return None
+
+        token = get_credentials(request, **kwargs)
+        if token is None:
+            return None
+
+        if settings.JWT_USER_CACHE_TIMEOUT:
+            user = get_cached_user(token)
+            if user is not None:
+                return user
+
+        if is_revoked(token):
+            raise JSONWebTokenError('Token is revoked')
+        user = super().authenticate(request, **kwargs)
+        if user is not None and settings.JWT_USER_CACHE_TIMEOUT:
+            # reloaded after reading the generation, a change of the user meanwhile outdates the snapshot
+            generation = get_generation(user.pk)
+            user.refresh_from_db()
+            cache_user(token, user, generation)
+        return user
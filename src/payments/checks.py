@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, register
+
+# backends keeping entries in the memory of a single process
+LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+        Invalidations have to reach every worker and management command, so features keeping state
+        in the default cache require a backend shared between processes
+    """
+    features = [name for name, enabled in (
+        ('GRAPHQL_RESPONSE_CACHE_TIMEOUT', settings.GRAPHQL_RESPONSE_CACHE_TIMEOUT),
+        ('JWT_USER_CACHE_TIMEOUT', settings.JWT_USER_CACHE_TIMEOUT),
+        ('DATABASE_REPLICAS', settings.DATABASE_REPLICAS),
+    ) if enabled]
+    if not features or not isinstance(caches['default'], LOCAL_BACKENDS):
+        return []
+    return [Error(
+        '{} require a cache shared between processes'.format(', '.join(features)),
+        hint='Set CACHE_BACKEND and CACHE_LOCATION, e.g. to memcached',
+        id='payments.E001',
+    )]
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from sys import exc_info
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models.query import QuerySet
+from promise import Promise
+
+from payments import instrumentation, routers
+
+# request state kept in thread locals, handed over to the pool threads
+_LOCALS = (routers._local, instrumentation._local)
+
+_pool = None
+_pool_lock = threading.Lock()
+# request last served by a pool thread
+_thread = threading.local()
+
+
+def get_pool():
+    """
+        Process wide pool of `GRAPHQL_EXECUTOR_THREADS` threads, each keeps at most one database connection
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.GRAPHQL_EXECUTOR_THREADS, thread_name_prefix='graphql')
+    return _pool
+
+
+def _run(request, state, fn, args, kwargs):
+    if getattr(_thread, 'request', None) is not request:
+        # first field of a request on this thread, what `request_started` does for the request thread.
+        # The connection is reused by the other fields of the request and kept until the next one.
+        close_old_connections()
+        _thread.request = request
+    for local, values in zip(_LOCALS, state):
+        local.__dict__.update(values)
+    try:
+        result = fn(*args, **kwargs)
+        # querysets are lazy, evaluate them here rather than on the request thread
+        return list(result) if isinstance(result, QuerySet) else result
+    finally:
+        for local in _LOCALS:
+            local.__dict__.clear()
+
+
+class PoolExecutor:
+    """
+        graphql-core executor resolving the root fields of an operation concurrently on the bounded pool.
+        Nested fields are resolved inline on the request thread, like with the default `SyncExecutor`.
+        SQL issued on the pool is not counted by `payments.instrumentation`.
+        Pool threads check their database connection once per request, not per field.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
+        self.pending = []
+        # identifies the request to the pool threads
+        self.request = object()
+
+    def execute(self, fn, *args, **kwargs):
+        info = args[1]
+        if len(info.path) > 1:
+            return fn(*args, **kwargs)
+
+        promise = Promise()
+        state = tuple(dict(local.__dict__) for local in _LOCALS)
+        self.pending.append((self.pool.submit(_run, self.request, state, fn, args, kwargs), promise))
+        return promise
+
+    def wait_until_finished(self):
+        # promises are settled on the request thread, so completing nested fields stays there too
+        while self.pending:
+            pending, self.pending = self.pending, []
+            wait([future for future, _ in pending])
+            for future, promise in pending:
+                try:
+                    promise.do_resolve(future.result())
+                except Exception as e:
+                    promise.do_reject(e, traceback=exc_info()[2])
+
+    def clean(self):
+        self.pending = []
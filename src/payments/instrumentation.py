@@ -0,0 +1,194 @@
+import random
+import threading
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+
+METRICS = {
+    'fannypack_operation_seconds': ('summary', 'Wall time of sampled GraphQL operations'),
+    'fannypack_operation_sql_queries_total': ('counter', 'SQL queries issued by sampled GraphQL operations'),
+    'fannypack_operation_sql_seconds_total': ('counter', 'Time spent in SQL by sampled GraphQL operations'),
+    'fannypack_operation_engine_seconds_total': ('counter', 'Time spent in the settlement engine by sampled operations'),
+    'fannypack_resolver_seconds': ('summary', 'Wall time of resolvers in sampled operations, children excluded'),
+    'fannypack_resolver_sql_queries_total': ('counter', 'SQL queries issued by resolvers in sampled operations'),
+    'fannypack_engine_seconds': ('summary', 'Wall time of settlement engine calls in sampled operations'),
+}
+
+_local = threading.local()
+
+
+class Registry:
+    """
+        In-process store of sampled measurements, rendered in Prometheus text format.
+        Every worker process keeps its own registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, name, labels, value=1.0):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            key = tuple(sorted(labels.items()))
+            self._values[(name + '_sum', key)] += seconds
+            self._values[(name + '_count', key)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = [
+            '# TYPE fannypack_metrics_sample_rate gauge',
+            'fannypack_metrics_sample_rate {}'.format(settings.GRAPHQL_METRICS_SAMPLE_RATE),
+        ]
+        for name, (kind, help_text) in METRICS.items():
+            samples = [(n, labels, v) for (n, labels), v in values if n in (name, name + '_sum', name + '_count')]
+            if not samples:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample_name, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append('{}{{{}}} {}'.format(sample_name, label_text, repr(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Trace:
+    def __init__(self, extensions):
+        self.operation = 'unnamed'
+        self.extensions = extensions
+        self.started = perf_counter()
+        self.duration = 0.0
+        self.queries = 0
+        self.sql_time = 0.0
+        self.engine_time = 0.0
+        self.resolvers = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'sqlQueries': 0})
+
+    def elapsed(self):
+        return perf_counter() - self.started
+
+    def as_extension(self):
+        return {
+            'duration': self.duration,
+            'sqlQueries': self.queries,
+            'sqlDuration': self.sql_time,
+            'engineDuration': self.engine_time,
+            'resolvers': dict(self.resolvers),
+        }
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def operation_label(operation_name):
+    """
+        `operationName` is chosen by clients, only the names in `GRAPHQL_METRICS_OPERATIONS` become labels
+    """
+    if not operation_name:
+        return 'unnamed'
+    return operation_name if operation_name in settings.GRAPHQL_METRICS_OPERATIONS else 'other'
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    trace = current()
+    if trace is None:
+        return execute(sql, params, many, context)
+
+    started = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.queries += 1
+        trace.sql_time += perf_counter() - started
+
+
+@contextmanager
+def trace_request():
+    """
+        Sample the current request with probability `GRAPHQL_METRICS_SAMPLE_RATE` and record it.
+        Yields the `Trace` or None when the request is not sampled.
+    """
+    rate = settings.GRAPHQL_METRICS_SAMPLE_RATE
+    if rate <= 0 or random.random() >= rate:
+        yield None
+        return
+
+    trace = _local.trace = Trace(extensions=settings.GRAPHQL_METRICS_EXTENSIONS)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(_sql_wrapper))
+            yield trace
+    finally:
+        _local.trace = None
+        trace.duration = trace.elapsed()
+        labels = {'operation': trace.operation}
+        registry.observe('fannypack_operation_seconds', labels, trace.duration)
+        registry.inc('fannypack_operation_sql_queries_total', labels, trace.queries)
+        registry.inc('fannypack_operation_sql_seconds_total', labels, trace.sql_time)
+        registry.inc('fannypack_operation_engine_seconds_total', labels, trace.engine_time)
+        for field, stats in trace.resolvers.items():
+            registry.inc('fannypack_resolver_seconds_sum', {'field': field}, stats['duration'])
+            registry.inc('fannypack_resolver_seconds_count', {'field': field}, stats['count'])
+            registry.inc('fannypack_resolver_sql_queries_total', {'field': field}, stats['sqlQueries'])
+
+
+def timed(name):
+    """
+        Decorator adding the wall time of the wrapped call to the sampled trace, if any
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current()
+            if trace is None:
+                return func(*args, **kwargs)
+
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - started
+                trace.engine_time += elapsed
+                registry.observe('fannypack_engine_seconds', {'name': name}, elapsed)
+        return wrapper
+    return decorator
+
+
+class TimingMiddleware:
+    """
+        Graphene middleware recording time and SQL queries per resolver of sampled operations.
+        Queries of a resolver returning a lazy QuerySet run when graphene completes the field, after the
+        resolver returned, so they are counted by the operation but not by the resolver.
+    """
+
+    def resolve(self, next, root, info, **kwargs):
+        trace = current()
+        if trace is None:
+            return next(root, info, **kwargs)
+
+        queries = trace.queries
+        started = perf_counter()
+        try:
+            return next(root, info, **kwargs)
+        finally:
+            stats = trace.resolvers['{}.{}'.format(info.parent_type.name, info.field_name)]
+            stats['count'] += 1
+            stats['duration'] += perf_counter() - started
+            stats['sqlQueries'] += trace.queries - queries
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments.models import ArchivedPayment
+
+
+class Command(BaseCommand):
+    help = 'Move payments older than --days to the archive table, room balances are not affected'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        archived = ArchivedPayment.archive(before, batch_size=options['batch_size'])
+        self.stdout.write('Archived {} payments older than {}'.format(archived, before.isoformat()))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the settlement engine on synthetic rooms and store the results as a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,10,100,1000',
+                            help='comma separated room sizes, up to 10000 users. run is timed on rooms of up to {} '
+                                 'users by default, it grows with the cube of the room size'.format(
+                                     benchmark.DEFAULT_LIMITS['run']))
+        parser.add_argument('--payments-per-user', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--operations', default=','.join(benchmark.OPERATIONS))
+        parser.add_argument('--limit', action='append', default=[], metavar='OPERATION=USERS',
+                            help='largest room an operation is timed on, e.g. run=500, larger rooms are '
+                                 'reported as skipped')
+        parser.add_argument('--timeout', type=float, default=benchmark.DEFAULT_TIMEOUT,
+                            help='seconds an operation may take, slower ones are reported as not measurable')
+        parser.add_argument('--output', default='engine-benchmark.json')
+        parser.add_argument('--baseline', help='previous output to compare against')
+        parser.add_argument('--threshold', type=float, default=1.1,
+                            help='slowdown ratio reported as a regression')
+
+    def handle(self, *args, **options):
+        limits = dict(benchmark.DEFAULT_LIMITS)
+        for limit in options['limit']:
+            try:
+                name, users = limit.split('=')
+                limits[name] = int(users)
+            except ValueError:
+                raise CommandError('Invalid limit "{}", expected OPERATION=USERS'.format(limit))
+
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = benchmark.run_benchmark(
+            sizes,
+            payments_per_user=options['payments_per_user'],
+            repeat=options['repeat'],
+            seed=options['seed'],
+            operations=options['operations'].split(','),
+            limits=limits,
+            timeout=options['timeout'],
+        )
+        benchmark.save(results, options['output'])
+
+        for size, operations in results['results'].items():
+            for name in benchmark.OPERATIONS:
+                if name in operations:
+                    line = '{:>6} {:<20} {}'.format(size, name, operations[name])
+                    measured = 'seconds' in operations[name]
+                    self.stdout.write(line if measured else self.style.WARNING(line))
+            self.stdout.write('{:>6} {:<20} {}'.format(size, 'memory', operations['memory']))
+        self.stdout.write('Results written to {}'.format(options['output']))
+
+        if options['baseline']:
+            rows = benchmark.compare(benchmark.load(options['baseline']), results, options['threshold'])
+            regressions = 0
+            for size, name, before, after, ratio, regressed in rows:
+                regressions += regressed
+                line = '{:>6} {:<20} {:.6f}s -> {:.6f}s ({:.2f}x)'.format(size, name, before, after, ratio)
+                self.stdout.write(self.style.ERROR(line) if regressed else line)
+            if regressions:
+                raise CommandError('{} operations regressed by more than {}x'.format(regressions, options['threshold']))
@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.models import Room
+from payments.utils import export
+
+
+class Command(BaseCommand):
+    help = 'Export payment history or current balances of a room without loading it into memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--table', choices=sorted(export.TABLES), default='payments')
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument('--output', help='file to write, standard output by default')
+
+    def handle(self, *args, **options):
+        if not Room.objects.filter(id=options['room_id']).exists():
+            raise CommandError("room doesn't exist")
+
+        try:
+            content = export.export(options['room_id'], options['table'], options['format'], options['chunk_size'])
+        except Exception as e:
+            raise CommandError(str(e))
+
+        binary = options['format'] == 'arrow'
+        if options['output']:
+            out = open(options['output'], 'wb' if binary else 'w', newline=None if binary else '')
+        else:
+            out = sys.stdout.buffer if binary else sys.stdout
+        try:
+            for chunk in content:
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
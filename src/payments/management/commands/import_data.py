@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils import importer
+
+
+class Command(BaseCommand):
+    help = 'Bulk import users, rooms, room members and payment history from CSV or NDJSON files'
+
+    def add_arguments(self, parser):
+        for kind, fields in importer.FIELDS.items():
+            parser.add_argument('--' + kind, metavar='FILE', help='columns: ' + ', '.join(fields))
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+        parser.add_argument('--processes', type=int, default=1, help='processes hashing passwords')
+
+    def handle(self, *args, **options):
+        files = {kind: open(options[kind], newline='') for kind in importer.FIELDS if options[kind]}
+        try:
+            records = {kind: importer.read_records(file, file.name) for kind, file in files.items()}
+            counts = importer.run(batch_size=options['batch_size'], processes=options['processes'], **records)
+        except Exception as e:
+            raise CommandError(str(e))
+        finally:
+            for file in files.values():
+                file.close()
+
+        for name, count in sorted(counts.items()):
+            self.stdout.write('{:<15} {}'.format(name, count))
@@ -0,0 +1,58 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+HEAVY_MODULES = ['pandas', 'numpy', 'payments.utils.optimization']
+
+
+def profile_imports(modules):
+    """
+        Import `modules` in a fresh interpreter under `-X importtime`.
+        Returns the wall time in seconds, the names of all loaded modules and `(module, self us, cumulative us)`
+        rows. Modules loaded through `importlib.import_module`, e.g. Django apps, get no row of their own.
+    """
+    code = (
+        'import json, sys, time; started = time.perf_counter(); '
+        'import django; django.setup(); ' + ''.join('import {}; '.format(module) for module in modules) +
+        'print(json.dumps([time.perf_counter() - started, sorted(sys.modules)]))'
+    )
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=os.environ.copy(), universal_newlines=True,
+    )
+    if process.returncode:
+        raise CommandError(process.stderr)
+
+    rows = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((module, int(self_us), int(cumulative_us)))
+
+    seconds, loaded = json.loads(process.stdout.splitlines()[-1])
+    return seconds, set(loaded), rows
+
+
+class Command(BaseCommand):
+    help = 'Report where worker start-up time goes by profiling imports in a fresh interpreter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', default=['fannypack.wsgi'])
+        parser.add_argument('--top', type=int, default=20)
+
+    def handle(self, *args, **options):
+        seconds, loaded, rows = profile_imports(options['modules'])
+
+        self.stdout.write('{:>10} {:>10}  {}'.format('self ms', 'cumul. ms', 'module'))
+        for module, self_us, cumulative_us in sorted(rows, key=lambda r: -r[2])[:options['top']]:
+            self.stdout.write('{:>10.1f} {:>10.1f}  {}'.format(self_us / 1000, cumulative_us / 1000, module))
+
+        self.stdout.write('Start-up import time: {:.1f} ms, {} modules'.format(seconds * 1000, len(loaded)))
+        for module in HEAVY_MODULES:
+            self.stdout.write('{}: {}'.format(module, 'imported' if module in loaded else 'not imported'))
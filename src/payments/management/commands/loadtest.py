@@ -0,0 +1,96 @@
+import json
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from payments.models import Room, User
+from payments.utils import engine, loadtest
+
+PASSWORD = 'loadtest-password'
+
+
+class Command(BaseCommand):
+    help = 'Seed users and rooms, then drive a running GraphQL server with a scripted traffic profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8080/graphql/')
+        parser.add_argument('--profile', choices=sorted(loadtest.PROFILES), default='mixed')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--duration', type=int, default=30, help='seconds')
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--members', type=int, default=10, help='members per room')
+        parser.add_argument('--spare-users', type=int, default=100, help='users left for addUserToRoom')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--metrics-token', help='METRICS_TOKEN of the server, SQL queries per operation are '
+                                                    'read from /metrics/')
+        parser.add_argument('--output', help='write the report as JSON')
+        parser.add_argument('--baseline', help='previous report to compare against')
+
+    @transaction.atomic
+    def seed(self, rooms, members, spare_users, seed):
+        """
+            Create the load test fixtures, all users share one password hash
+        """
+        prefix = 'loadtest-{}-'.format(seed)
+        User.objects.filter(username__startswith=prefix).delete()
+        Room.objects.filter(name__startswith=prefix).delete()
+
+        password = make_password(PASSWORD)
+        users = User.objects.bulk_create(
+            User(username='{}{}'.format(prefix, i), password=password)
+            for i in range(rooms * members + spare_users)
+        )
+        users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+        fixtures = []
+        for r in range(rooms):
+            room_users = users[r * members:(r + 1) * members]
+            op = engine.Optimization()
+            op.create_matrix([u.id for u in room_users])
+            room = Room.objects.create(name='{}{}'.format(prefix, r), matrix=op.export_to_json())
+            User.rooms.through.objects.bulk_create(
+                User.rooms.through(user_id=u.id, room_id=room.id) for u in room_users
+            )
+            fixtures.append({'id': str(room.id), 'members': [u.username for u in room_users]})
+
+        return fixtures, [u.username for u in users[rooms * members:]]
+
+    def handle(self, *args, **options):
+        rooms, spare_users = self.seed(options['rooms'], options['members'], options['spare_users'], options['seed'])
+
+        test = loadtest.LoadTest(
+            options['url'],
+            rooms,
+            PASSWORD,
+            spare_users=spare_users,
+            profile=options['profile'],
+            concurrency=options['concurrency'],
+            duration=options['duration'],
+            seed=options['seed'],
+            metrics_token=options['metrics_token'],
+        )
+        report = test.run()
+        for warning in report['warnings']:
+            self.stdout.write(self.style.WARNING(warning))
+
+        self.stdout.write('{:<16} {:>9} {:>8} {:>10} {:>8} {:>8} {:>8} {:>8}'.format(
+            'operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        rows = list(report['operations'].items()) + [('total', report['total'])]
+        for name, stats in rows:
+            queries = stats.get('sql_queries')
+            self.stdout.write('{:<16} {:>9} {:>8} {:>10.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8}'.format(
+                name, stats['requests'], stats['errors'], stats['throughput'],
+                stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000,
+                '-' if queries is None else '{:.1f}'.format(queries),
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            for name, metric, before, after in loadtest.compare(baseline, report):
+                self.stdout.write('{:<16} {:<12} {:.4f} -> {:.4f}'.format(name, metric, before, after))
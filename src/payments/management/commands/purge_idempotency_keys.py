@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from payments.models import IdempotencyKey
+from payments.utils import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys older than IDEMPOTENCY_KEY_TIMEOUT, expired keys are never replayed'
+
+    def handle(self, *args, **options):
+        before = idempotency.expired_before()
+        purged = IdempotencyKey.purge(before)
+        self.stdout.write('Purged {} idempotency keys older than {}'.format(purged, before.isoformat()))
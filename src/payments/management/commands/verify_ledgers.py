@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils import ledger
+
+
+class Command(BaseCommand):
+    help = 'Recompute balances of every room from its payments and report or repair rooms whose matrix drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--shards', type=int, help='slices of the room id space, 4 per process by default')
+        parser.add_argument('--repair', action='store_true', help='rebuild drifted matrices from payments')
+        parser.add_argument('--tolerance', type=float, default=0.01)
+        parser.add_argument('--chunk-size', type=int, default=ledger.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        results = ledger.verify(
+            shards=options['shards'] or options['processes'] * 4,
+            processes=options['processes'],
+            repair=options['repair'],
+            tolerance=options['tolerance'],
+            chunk_size=options['chunk_size'],
+        )
+
+        drifted = []
+        for stats in results:
+            seconds = max(stats['seconds'], 1e-9)
+            self.stdout.write('shard {:>3} {:>8} rooms {:>10} payments {:>8.3f}s {:>10.1f} rooms/s {:>12.1f} payments/s'.format(
+                stats['shard'], stats['rooms'], stats['payments'], stats['seconds'],
+                stats['rooms'] / seconds, stats['payments'] / seconds))
+            drifted += stats['drifted']
+
+        for room_id, difference in drifted:
+            self.stdout.write(self.style.WARNING('room {} drifted by {:.2f}'.format(room_id, difference)))
+        if drifted and not options['repair']:
+            raise CommandError('{} rooms drifted, run with --repair to rebuild them'.format(len(drifted)))
+        self.stdout.write('{} rooms checked, {} repaired'.format(
+            sum(stats['rooms'] for stats in results), sum(stats['repaired'] for stats in results)))
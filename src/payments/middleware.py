@@ -0,0 +1,59 @@
+from django.contrib.auth import authenticate
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.middleware import JSONWebTokenMiddleware as BaseJSONWebTokenMiddleware
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.utils import get_credentials
+
+
+def _resolve_user(request, token, **kwargs):
+    """
+        Authenticate `token` at most once per request, the outcome is memoized on the request
+    """
+    resolved = request.__dict__.setdefault('_jwt_resolved', {})
+    if token not in resolved:
+        resolved[token] = authenticate(request=request, **kwargs)
+    return resolved[token]
+
+
+class JSONWebTokenMiddleware(BaseJSONWebTokenMiddleware):
+    """
+        Same contract as `graphql_jwt.middleware.JSONWebTokenMiddleware`, but a token is resolved
+        to a user once per request instead of once per request plus once per resolver
+    """
+
+    def __init__(self, get_response=None):
+        MiddlewareMixin.__init__(self, get_response)
+
+    def process_request(self, request):
+        token = get_credentials(request)
+        if token is not None and (not hasattr(request, 'user') or request.user.is_anonymous):
+            try:
+                user = _resolve_user(request, token)
+            except JSONWebTokenError as err:
+                return JsonResponse({
+                    'errors': [{'message': str(err)}],
+                }, status=401)
+
+            if user is not None:
+                request.user = request._cached_user = user
+        return None
+
+    def resolve(self, next, root, info, **kwargs):
+        context = info.context
+        token = get_credentials(context, **kwargs)
+
+        if token is not None and (not hasattr(context, 'user') or context.user.is_anonymous):
+            field = getattr(
+                info.schema,
+                'get_{}_type'.format(info.operation.operation),
+            )().fields.get(info.path[0])
+
+            if field is None or not jwt_settings.JWT_ALLOW_ANY_HANDLER(info, field, **kwargs):
+                user = _resolve_user(context, token, **kwargs)
+
+                if user is not None:
+                    context.user = context._cached_user = user
+
+        return next(root, info, **kwargs)
@@ -0,0 +1,80 @@
+# Generated by Django 2.1.5 on 2026-10-19 17:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_statistics(apps, schema_editor):
+    Payment = apps.get_model('payments', 'Payment')
+    RoomStatistics = apps.get_model('payments', 'RoomStatistics')
+    RoomSpending = apps.get_model('payments', 'RoomSpending')
+
+    statistics = {}
+    spending = {}
+    for payment in Payment.objects.order_by().iterator():
+        members = statistics.setdefault(payment.room_id, {})
+        drawee = members.setdefault(payment.drawee_id, [0.0, 0.0, 0])
+        pledger = members.setdefault(payment.pledger_id, [0.0, 0.0, 0])
+        drawee[0] -= payment.amount
+        pledger[1] -= payment.amount
+        drawee[2] += 1
+        if pledger is not drawee:
+            pledger[2] += 1
+
+        day = payment.date.date()
+        for period, start in (('day', day), ('month', day.replace(day=1))):
+            bucket = spending.setdefault((payment.room_id, period, start), [0.0, 0])
+            bucket[0] += abs(payment.amount)
+            bucket[1] += 1
+
+    RoomStatistics.objects.bulk_create(
+        RoomStatistics(room_id=room_id, user_id=user_id, paid=paid, owed=owed, payments_count=count)
+        for room_id, members in statistics.items()
+        for user_id, (paid, owed, count) in members.items()
+    )
+    RoomSpending.objects.bulk_create(
+        RoomSpending(room_id=room_id, period=period, start=start, amount=amount, payments_count=count)
+        for (room_id, period, start), (amount, count) in spending.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSpending',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('start', models.DateField()),
+                ('amount', models.FloatField(default=0.0)),
+                ('payments_count', models.IntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spending', to='payments.Room')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RoomStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('paid', models.FloatField(default=0.0)),
+                ('owed', models.FloatField(default=0.0)),
+                ('payments_count', models.IntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='payments.Room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='roomstatistics',
+            unique_together={('room', 'user')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='roomspending',
+            unique_together={('room', 'period', 'start')},
+        ),
+        migrations.RunPython(backfill_statistics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.5 on 2026-10-19 17:06
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_balance(apps, schema_editor):
+    RoomStatistics = apps.get_model('payments', 'RoomStatistics')
+    RoomStatistics.objects.update(balance=F('paid') - F('owed'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_room_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomstatistics',
+            name='balance',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddIndex(
+            model_name='roomstatistics',
+            index=models.Index(fields=['room', 'balance'], name='payments_ro_room_id_b32219_idx'),
+        ),
+        migrations.RunPython(backfill_balance, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.1.5 on 2026-10-19 18:02
+
+import json
+
+from django.db import migrations
+
+
+def _rekey(apps, key_field, value_field):
+    Room = apps.get_model('payments', 'Room')
+    User = apps.get_model('payments', 'User')
+    keys = {str(key): str(value) for key, value in User.objects.values_list(key_field, value_field)}
+
+    for room in Room.objects.only('id', 'matrix').iterator():
+        columns = json.loads(room.matrix or '{}')
+        # users deleted meanwhile are dropped, their payments were deleted with them
+        matrix = {keys[column]: {keys[row]: value for row, value in rows.items() if row in keys}
+                  for column, rows in columns.items() if column in keys}
+        room.matrix = json.dumps(matrix, separators=(',', ':'))
+        room.save(update_fields=['matrix'])
+
+
+def usernames_to_ids(apps, schema_editor):
+    _rekey(apps, 'username', 'id')
+
+
+def ids_to_usernames(apps, schema_editor):
+    _rekey(apps, 'id', 'username')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_payment_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(usernames_to_ids, ids_to_usernames),
+    ]
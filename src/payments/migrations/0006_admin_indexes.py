@@ -0,0 +1,22 @@
+# Generated by Django 2.1.5 on 2026-10-19 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_matrix_user_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='room',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-date'], name='payments_pa_date_2520d6_idx'),
+        ),
+    ]
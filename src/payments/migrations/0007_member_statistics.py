@@ -0,0 +1,26 @@
+# Generated by Django 2.1.5 on 2026-10-19 19:10
+
+from django.db import migrations
+
+
+def create_member_statistics(apps, schema_editor):
+    RoomStatistics = apps.get_model('payments', 'RoomStatistics')
+    Membership = apps.get_model('payments', 'User').rooms.through
+    existing = set(RoomStatistics.objects.values_list('room_id', 'user_id'))
+    RoomStatistics.objects.bulk_create(
+        (RoomStatistics(room_id=room_id, user_id=user_id)
+         for room_id, user_id in Membership.objects.values_list('room_id', 'user_id').iterator()
+         if (room_id, user_id) not in existing),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_member_statistics, migrations.RunPython.noop),
+    ]
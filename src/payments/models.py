@@ -1,19 +1,25 @@
+import logging
 import uuid
 from decimal import Decimal
 
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, models
 from django.db import transaction
+from django.db.models import F, Sum
 
-from payments.utils.optimization import Optimization
+from payments.utils import engine
 from fannypack import settings
 
+from payments.backends import forget_user
+from payments.utils import responseCache
 from payments.utils.secretManager import check_password, hash_password
 
+logger = logging.getLogger(__name__)
+
 
 class Room(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
     matrix = models.TextField()
     total_balance = models.FloatField(default=0.0)
     biggest_pledger = models.CharField(max_length=30)
@@ -34,7 +40,7 @@ class Room(models.Model):
                 name=name
             )
 
-        op = Optimization()
+        op = engine.Optimization()
         op.create_matrix([])
         room.matrix = op.export_to_json()
         room.save()
@@ -46,48 +52,142 @@ class Room(models.Model):
             db_room = Room.objects.get(id=room_id)
             db_room.matrix = matrix
             db_room.save()
+            responseCache.invalidate(room_id)
             return db_room
         except Exception:
             raise Exception("room doesn't exist")
 
     def add_payment(self, payment):
         self.total_balance += abs(payment)
-        op = Optimization()
-        op.load_from_json(self.matrix)
-        self.biggest_pledger = op.get_biggest_pledger()
+        self.biggest_pledger = RoomStatistics.biggest_pledger(self.id)
         self.save()
 
+    def simulate_payments(self, payments):
+        """
+            Apply hypothetical `(drawee, pledger, amount)` payments to an in-memory copy of the room matrix.
+            Nothing is written, returns the resulting balances and transfers.
+        """
+        usernames = {username for drawee, pledger, _ in payments for username in (drawee, pledger)}
+        ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        unknown = usernames - set(ids)
+        if unknown:
+            raise Exception("users don't exist: {}".format(', '.join(sorted(unknown))))
+
+        op = engine.Optimization(room_id=self.id)
+        op.load_from_json(self.matrix)
+        for drawee, pledger, amount in payments:
+            op.add_payment(drawee=ids[drawee], pledger=ids[pledger], amount=float(amount))
+        op.run()
+
+        names = User.usernames(op.matrix.index)
+        balances = {names[user]: balance for user, balance in op.get_balances().items()}
+        transfers = [(names[debtor], names[creditor], amount) for debtor, creditor, amount in op.get_transfers()]
+        return balances, transfers
+
+    @staticmethod
+    def consolidated_settlement(room_ids):
+        """
+            One settlement plan for several rooms, returned as `(debtor, creditor, amount)` triples.
+            Balances of members are summed over the rooms by the database in a single query.
+        """
+        balances = dict(
+            RoomStatistics.objects.filter(room_id__in=room_ids)
+            .values_list('user__username')
+            .annotate(total=Sum('balance'))
+            .order_by('user__username')
+        )
+        if not balances:
+            return []
+
+        op = engine.Optimization()
+        op.create_from_balances(balances)
+        op.run()
+        return op.get_transfers()
+
+    def check_secret(self, secret):
+        if self.secret:
+            if secret is None:
+                raise Exception("Room is protected by password")
+            if not check_password(self.secret, secret):
+                raise Exception("Incorrect password")
+
     def add_user(self, user):
-        op = Optimization()
+        return self.add_users([user])
+
+    def add_users(self, users):
+        op = engine.Optimization(room_id=self.id)
         op.load_from_json(self.matrix)
-        op.add_user(user.username)
+        op.add_users([user.id for user in users])
         self.matrix = op.export_to_json()
         self.save()
+        RoomStatistics.add_members(self.id, [user.id for user in users])
+        responseCache.invalidate(self.id)
         return self
 
+    @transaction.atomic
+    def add_members(self, usernames, secret=None):
+        """
+            Add many users at once: the secret is checked once, the matrix grows once
+            and the memberships are inserted with a single query. Returns the added users.
+            The room row is locked, concurrent additions read the matrix after this one wrote it.
+        """
+        room = Room.objects.select_for_update().get(id=self.id)
+        room.check_secret(secret)
+        users = list(User.objects.filter(username__in=usernames))
+        unknown = set(usernames) - {user.username for user in users}
+        if unknown:
+            raise Exception("users don't exist: {}".format(', '.join(sorted(unknown))))
+
+        members = set(room.user_set.values_list('id', flat=True))
+        users = [user for user in users if user.id not in members]
+        room.add_users(users)
+        self.matrix = room.matrix
+        Membership = User.rooms.through
+        Membership.objects.bulk_create(Membership(user_id=user.id, room_id=room.id) for user in users)
+        return users
+
 
 class User(AbstractUser):
     balance = models.DecimalField(default=0, decimal_places=5, max_digits=20)
     rooms = models.ManyToManyField(Room)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        forget_user(self.pk)
+
+    @staticmethod
+    def usernames(ids):
+        """
+            Map ids of room matrices to usernames, ids of deleted users map to themselves
+        """
+        ids = list(ids)
+        found = dict(User.objects.filter(id__in=[int(id) for id in ids]).values_list('id', 'username'))
+        return {id: found.get(int(id), str(id)) for id in ids}
+
     def add_user_to_room(self, room_id, secret=None):
         try:
-            room = Room.objects.get(id=room_id)
-            if room.secret:
-                if secret is None:
-                    raise Exception("Room is protected by password")
-                if not check_password(room.secret, secret):
-                    raise Exception("Incorrect password")
-            room.add_user(self)
-            self.rooms.add(room)
-            self.save()
+            with transaction.atomic():
+                room = Room.objects.select_for_update().get(id=room_id)
+                room.check_secret(secret)
+                room.add_user(self)
+                self.rooms.add(room)
+                self.save()
         except models.FieldDoesNotExist:
             raise Exception("room doesn't exist")
 
     def update_balance(self, value):
-        print(self.balance)
         self.balance += Decimal(str(value))
+        logger.debug('balance user=%s change=%s balance=%s', self.pk, value, self.balance)
         self.save()
+        User.balances_changed([self.pk])
+
+    @staticmethod
+    def balances_changed(user_ids):
+        """
+            Invalidate cached responses showing balances of the users, in any of their rooms
+        """
+        room_ids = User.rooms.through.objects.filter(user_id__in=user_ids).values_list('room_id', flat=True)
+        responseCache.invalidate_users(user_ids, set(room_ids))
 
 
 class Payment(models.Model):
@@ -99,6 +199,9 @@ class Payment(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     name = models.CharField(max_length=50)
 
+    class Meta:
+        indexes = [models.Index(fields=['room', '-date']), models.Index(fields=['-date'])]
+
     @staticmethod
     @transaction.atomic
     def create_payment(drawee, pledger, room_id, amount, name):
@@ -118,13 +221,14 @@ class Payment(models.Model):
         )
 
         try:
-            op = Optimization()
+            op = engine.Optimization(room_id=room_id)
             op.load_from_json(room_model.matrix)
-            op.add_payment(drawee=drawee, pledger=pledger, amount=float(amount))
+            op.add_payment(drawee=drawee.id, pledger=pledger.id, amount=float(amount))
             op.run()
             matrix = op.export_to_json()
 
             updated_room = Room.update_matrix(room_id=room_id, matrix=matrix)
+            RoomStatistics.add_payment(payment)
             updated_room.add_payment(amount)
 
             drawee.update_balance(-amount)
@@ -135,11 +239,14 @@ class Payment(models.Model):
             payment.delete()
             return
 
+        responseCache.invalidate(room_id)
         return {'payment': payment, 'matrix': updated_room}
 
     @staticmethod
     def delete_payment(id: int):
-        Payment.objects.get(id=id).delete()
+        payment = Payment.objects.get(id=id)
+        payment.delete()
+        responseCache.invalidate(payment.room_id)
 
     @staticmethod
     def delete_payment_keep_integrity(id: int):
@@ -156,6 +263,185 @@ class Payment(models.Model):
             payment.name,
         )
 
+        RoomStatistics.add_payment(inverted_payment['payment'], sign=-1)
+        RoomStatistics.add_payment(payment, sign=-1)
+
         inverted_payment['payment'].delete()
         payment.delete()
 
+
+def _increment(model, lookup, **values):
+    """
+        Add `values` to the row matching `lookup`, creating it when missing
+    """
+    changes = {field: F(field) + value for field, value in values.items()}
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **values)
+    except IntegrityError:
+        model.objects.filter(**lookup).update(**changes)
+
+
+class RoomStatistics(models.Model):
+    """
+        Running totals of a room member, `balance` is `paid` - `owed`.
+        The (room, balance) index keeps members of a room ordered by balance, so the biggest
+        debtors and creditors of a room are a single index range scan.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='statistics')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    paid = models.FloatField(default=0.0)
+    owed = models.FloatField(default=0.0)
+    balance = models.FloatField(default=0.0)
+    payments_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room', 'user')
+        indexes = [models.Index(fields=['room', 'balance'])]
+
+    @staticmethod
+    def debtors(room_id, k):
+        return RoomStatistics.objects.filter(room_id=room_id, balance__lt=0).order_by('balance')[:k]
+
+    @staticmethod
+    def creditors(room_id, k):
+        return RoomStatistics.objects.filter(room_id=room_id, balance__gt=0).order_by('-balance')[:k]
+
+    @staticmethod
+    def biggest_pledger(room_id):
+        debtor = RoomStatistics.debtors(room_id, 1).values_list('user__username', flat=True).first()
+        return debtor or ''
+
+    @staticmethod
+    def add_members(room_id, user_ids):
+        """
+            Zero statistics for new members, so members without payments are ranked like the others
+        """
+        existing = set(RoomStatistics.objects.filter(room_id=room_id, user_id__in=user_ids)
+                       .values_list('user_id', flat=True))
+        RoomStatistics.objects.bulk_create(
+            RoomStatistics(room_id=room_id, user_id=user_id) for user_id in user_ids if user_id not in existing)
+
+    @staticmethod
+    def rank(room_id, user_id):
+        """
+            1-based position of the user among room members ordered from the biggest debtor,
+            members with the same balance share it.
+            Two queries: the balance of the user, then a count over the (room, balance) index range
+            below it. The count reads index entries only, its cost grows with the position of the user
+            rather than with the size of the payment history.
+        """
+        balance = RoomStatistics.objects.filter(room_id=room_id, user_id=user_id).values_list('balance', flat=True).first()
+        if balance is None:
+            # members without payments have no statistics yet
+            balance = 0.0
+        return RoomStatistics.objects.filter(room_id=room_id, balance__lt=balance).count() + 1
+
+    @staticmethod
+    def add_payment(payment, sign=1):
+        """
+            Account `payment` into the member statistics and spending buckets of its room,
+            `sign=-1` takes an accounted payment back out
+        """
+        value = -payment.amount * sign
+        if payment.drawee_id == payment.pledger_id:
+            _increment(RoomStatistics, {'room_id': payment.room_id, 'user_id': payment.drawee_id},
+                       paid=value, owed=value, payments_count=sign)
+        else:
+            _increment(RoomStatistics, {'room_id': payment.room_id, 'user_id': payment.drawee_id},
+                       paid=value, balance=value, payments_count=sign)
+            _increment(RoomStatistics, {'room_id': payment.room_id, 'user_id': payment.pledger_id},
+                       owed=value, balance=-value, payments_count=sign)
+
+        day = payment.date.date()
+        for period, start in ((RoomSpending.DAY, day), (RoomSpending.MONTH, day.replace(day=1))):
+            _increment(RoomSpending, {'room_id': payment.room_id, 'period': period, 'start': start},
+                       amount=abs(payment.amount) * sign, payments_count=sign)
+
+
+class RoomSpending(models.Model):
+    DAY = 'day'
+    MONTH = 'month'
+    PERIODS = ((DAY, 'Day'), (MONTH, 'Month'))
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='spending')
+    period = models.CharField(max_length=5, choices=PERIODS)
+    start = models.DateField()
+    amount = models.FloatField(default=0.0)
+    payments_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room', 'period', 'start')
+
+
+class ArchivedPayment(models.Model):
+    """
+        Cold history moved out of `Payment` by `archive`, the room matrix and statistics already account for it.
+        The room column is covered by the (room, date) index. Users keep their own indexes, deleting a user
+        cascades to the archive and would scan it whole otherwise.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)
+    drawee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    pledger = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False)
+    amount = models.FloatField()
+    date = models.DateTimeField()
+    name = models.CharField(max_length=50)
+
+    FIELDS = ('id', 'drawee_id', 'pledger_id', 'room_id', 'amount', 'date', 'name')
+
+    class Meta:
+        indexes = [models.Index(fields=['room', 'date'])]
+
+    @staticmethod
+    def archive(before, batch_size=1000):
+        """
+            Move payments older than `before` to the archive, `batch_size` rows per transaction.
+            Returns the number of archived payments.
+        """
+        archived = 0
+        while True:
+            with transaction.atomic():
+                batch = list(Payment.objects.filter(date__lt=before).order_by('date').values(*ArchivedPayment.FIELDS)
+                             [:batch_size])
+                if not batch:
+                    return archived
+                ArchivedPayment.objects.bulk_create(ArchivedPayment(**row) for row in batch)
+                Payment.objects.filter(id__in=[row['id'] for row in batch]).delete()
+                for room_id in {row['room_id'] for row in batch}:
+                    responseCache.invalidate(room_id)
+            archived += len(batch)
+
+
+class IdempotencyKey(models.Model):
+    """
+        Result of a mutation stored under the idempotency key the client sent with it.
+        The row is written in the transaction of the mutation, a result is stored exactly when the mutation
+        committed. Rows older than `IDEMPOTENCY_KEY_TIMEOUT` seconds are ignored and removed by `purge`.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    operation = models.CharField(max_length=30)
+    key = models.CharField(max_length=255)
+    digest = models.CharField(max_length=32)
+    result = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'operation', 'key')
+
+    @staticmethod
+    def purge(before):
+        """
+            Delete keys created before `before`, returns the number of deleted keys
+        """
+        return IdempotencyKey.objects.filter(created__lt=before).delete()[0]
+
+
+class RevokedToken(models.Model):
+    """
+        SHA-256 of a JWT revoked by logging out, kept until the token `expires`
+    """
+    token = models.CharField(max_length=64, primary_key=True)
+    expires = models.DateTimeField(null=True, db_index=True)
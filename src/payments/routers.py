@@ -0,0 +1,70 @@
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_KEY = 'db-primary:{}'
+
+_local = threading.local()
+
+
+def _atomic_depth():
+    connection = connections[DEFAULT_DB_ALIAS]
+    return len(connection.savepoint_ids) if connection.in_atomic_block else -1
+
+
+def pin_primary(user_id):
+    """
+        Serve reads of the user from the primary for `REPLICA_STICKY_SECONDS`, called after their mutations
+    """
+    if user_id is not None and settings.DATABASE_REPLICAS and settings.REPLICA_STICKY_SECONDS:
+        cache.set(STICKY_KEY.format(user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+def is_pinned(user_id):
+    return user_id is not None and cache.get(STICKY_KEY.format(user_id), False)
+
+
+@contextmanager
+def read_from_replica(enabled=True):
+    """
+        Route reads inside the block to one randomly chosen replica, if any are configured
+    """
+    previous = getattr(_local, 'replica', None)
+    if enabled and settings.DATABASE_REPLICAS:
+        _local.replica = (random.choice(settings.DATABASE_REPLICAS), _atomic_depth())
+    else:
+        _local.replica = None
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+class ReplicaRouter:
+    """
+        Reads go to the replica chosen by `read_from_replica`, everything else to `default`.
+        Reads inside a `transaction.atomic` block opened within `read_from_replica` stay on `default`.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = getattr(_local, 'replica', None)
+        if replica is None:
+            return DEFAULT_DB_ALIAS
+        alias, depth = replica
+        if _atomic_depth() > depth:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
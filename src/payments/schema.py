@@ -1,8 +1,31 @@
+import json
+
 import graphene
 from django.contrib.auth import get_user_model
 from graphene_django import DjangoObjectType
+from graphql_jwt.utils import get_credentials
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .backends import revoke_token
+from .models import ArchivedPayment, Room, Payment, RoomSpending, RoomStatistics, User
+from .utils import idempotency, matrixEncoding
+
+
+class UsernameLoader(DataLoader):
+    def batch_load_fn(self, ids):
+        names = User.usernames(ids)
+        return Promise.resolve([names[id] for id in ids])
+
 
-from .models import Room, Payment, User
+def usernames(info):
+    """
+        Loader of usernames by user id, shared by the resolvers of one request
+    """
+    loader = getattr(info.context, 'graphql_usernames', None)
+    if loader is None:
+        loader = info.context.graphql_usernames = UsernameLoader()
+    return loader
 
 
 class UserType(DjangoObjectType):
@@ -11,15 +34,64 @@ class UserType(DjangoObjectType):
 
 
 class RoomType(DjangoObjectType):
+    matrix = graphene.String(encoding=graphene.String(default_value=matrixEncoding.NESTED),
+                             user_ids=graphene.Boolean(default_value=False))
+
     class Meta:
         model = Room
 
+    def resolve_matrix(self, info, encoding, user_ids):
+        """
+            `nested` (default), `dense` or `sparse`, see `payments.utils.matrixEncoding`.
+            Users are labeled by username, `userIds: true` returns the matrix as stored, keyed by user id.
+            Usernames of all rooms resolved by an operation are looked up by a single query.
+        """
+        if user_ids:
+            return matrixEncoding.encode(self.matrix, encoding)
+
+        columns = json.loads(self.matrix)
+        ids = list(columns)
+        return usernames(info).load_many(ids).then(
+            lambda names: matrixEncoding.encode(columns, encoding, lambda _: dict(zip(ids, names))))
+
 
 class PaymentType(DjangoObjectType):
     class Meta:
         model = Payment
 
 
+class RoomStatisticsType(DjangoObjectType):
+    class Meta:
+        model = RoomStatistics
+
+
+class RoomSpendingType(DjangoObjectType):
+    class Meta:
+        model = RoomSpending
+
+
+class TransferType(graphene.ObjectType):
+    debtor = graphene.String()
+    creditor = graphene.String()
+    amount = graphene.Float()
+
+
+class BalanceType(graphene.ObjectType):
+    username = graphene.String()
+    balance = graphene.Float()
+
+
+class SimulationType(graphene.ObjectType):
+    balances = graphene.List(BalanceType)
+    transfers = graphene.List(TransferType)
+
+
+class PaymentInput(graphene.InputObjectType):
+    drawee = graphene.String(required=True)
+    pledger = graphene.String(required=True)
+    amount = graphene.Float(required=True)
+
+
 class Outcome(graphene.ObjectType):
     message = graphene.String()
 
@@ -79,6 +151,23 @@ class AddUserToRoom(graphene.Mutation):
         return AddUserToRoom(user)
 
 
+class AddUsersToRoom(graphene.Mutation):
+    users = graphene.List(UserType)
+    room = graphene.Field(RoomType)
+
+    class Arguments:
+        room_id = graphene.String(required=True)
+        usernames = graphene.List(graphene.String, required=True)
+        secret = graphene.String(required=False)
+
+    def mutate(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        room = Room.objects.get(id=kwargs.get('room_id'))
+        users = room.add_members(kwargs.get('usernames'), kwargs.get('secret') or None)
+        return AddUsersToRoom(users=users, room=room)
+
+
 class MakePayment(graphene.Mutation):
     matrix = graphene.Field(RoomType)
     payment = graphene.Field(PaymentType)
@@ -89,34 +178,69 @@ class MakePayment(graphene.Mutation):
         room_id = graphene.String(required=True)
         amount = graphene.Float(required=True)
         name = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
-    def mutate(self, info, **kwargs):
+    def mutate(self, info, idempotency_key=None, **kwargs):
+        """
+            Retries with the same `idempotencyKey` return the payment created by the first call
+        """
         if info.context.user.is_anonymous:
             raise Exception('Not logged in!')
-        payment = Payment.create_payment(**kwargs)
-        return MakePayment(payment['matrix'], payment['payment'])
+
+        def run():
+            return str(Payment.create_payment(**kwargs)['payment'].id)
+
+        payment_id = idempotency.once(info.context.user.id, 'makePayment', idempotency_key, kwargs, run)
+        payment = Payment.objects.select_related('room').filter(id=payment_id).first()
+        if payment is None:
+            # a replay after the payment was archived or deleted
+            archived = ArchivedPayment.objects.filter(id=payment_id).values(*ArchivedPayment.FIELDS).first()
+            if archived is None:
+                raise Exception('Payment made with this idempotency key was deleted')
+            payment = Payment(**archived)
+        return MakePayment(payment.room, payment)
 
 
 class DeletePayment(graphene.Mutation):
     class Arguments:
         id = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
     Output = Outcome
 
-    def mutate(self, info, **kwargs):
+    def mutate(self, info, idempotency_key=None, **kwargs):
         if info.context.user.is_anonymous:
             raise Exception('Not logged in!')
-        Payment.delete_payment_keep_integrity(**kwargs)
-        outcome_message = "Payment " + kwargs.get('id') + " was deleted"
+
+        def run():
+            Payment.delete_payment_keep_integrity(**kwargs)
+            return "Payment " + kwargs.get('id') + " was deleted"
+
+        outcome_message = idempotency.once(info.context.user.id, 'deletePayment', idempotency_key, kwargs, run)
         return Outcome(message=outcome_message)
 
 
+class Logout(graphene.Mutation):
+    Output = Outcome
+
+    def mutate(self, info):
+        """
+            Revoke the token of the request, it is rejected from now on
+        """
+        token = get_credentials(info.context)
+        if token is not None:
+            revoke_token(token)
+        return Outcome(message="Logged out")
+
+
 class Mutation(graphene.ObjectType):
     create_user = CreateUser.Field()
     create_room = CreateRoom.Field()
     add_user_to_room = AddUserToRoom.Field()
+    add_users_to_room = AddUsersToRoom.Field()
     make_payment = MakePayment.Field()
     delete_payment = DeletePayment.Field()
+    logout = Logout.Field()
 
 
 class Query(graphene.ObjectType):
@@ -125,6 +249,16 @@ class Query(graphene.ObjectType):
     get_payments = graphene.List(PaymentType, room_id=graphene.String())
     users = graphene.List(UserType, room_id=graphene.String(required=False))
     me = graphene.Field(UserType)
+    room_statistics = graphene.List(RoomStatisticsType, room_id=graphene.String(required=True))
+    room_spending = graphene.List(RoomSpendingType, room_id=graphene.String(required=True),
+                                  period=graphene.String(default_value=RoomSpending.MONTH))
+    debtors = graphene.List(RoomStatisticsType, room_id=graphene.String(required=True), k=graphene.Int(default_value=10))
+    creditors = graphene.List(RoomStatisticsType, room_id=graphene.String(required=True), k=graphene.Int(default_value=10))
+    rank = graphene.Int(room_id=graphene.String(required=True), username=graphene.String(required=True))
+    consolidated_settlement = graphene.List(TransferType, user_id=graphene.String(),
+                                            room_ids=graphene.List(graphene.String))
+    simulate_payments = graphene.Field(SimulationType, room_id=graphene.String(required=True),
+                                       payments=graphene.List(PaymentInput, required=True))
 
     def resolve_users(self, info, **kwargs):
         if info.context.user.is_anonymous:
@@ -156,3 +290,61 @@ class Query(graphene.ObjectType):
         if info.context.user.is_anonymous:
             raise Exception('Not logged in!')
         return Payment.objects.filter(room__id=kwargs.get('room_id')).order_by('-date')[:10]
+
+    def resolve_room_statistics(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        return RoomStatistics.objects.filter(room__id=kwargs.get('room_id')).select_related('user')
+
+    def resolve_room_spending(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        return RoomSpending.objects.filter(room__id=kwargs.get('room_id'), period=kwargs.get('period')).order_by('start')
+
+    def resolve_debtors(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        return RoomStatistics.debtors(kwargs.get('room_id'), kwargs.get('k')).select_related('user')
+
+    def resolve_creditors(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        return RoomStatistics.creditors(kwargs.get('room_id'), kwargs.get('k')).select_related('user')
+
+    def resolve_rank(self, info, **kwargs):
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        user = get_user_model().objects.get(username=kwargs.get('username'))
+        return RoomStatistics.rank(kwargs.get('room_id'), user.id)
+
+    def resolve_consolidated_settlement(self, info, **kwargs):
+        """
+            Settle all rooms of `userId` (the caller by default) or the rooms listed in `roomIds` at once
+        """
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception('Not logged in!')
+
+        room_ids = kwargs.get('room_ids')
+        if room_ids is None:
+            if kwargs.get('user_id'):
+                user = get_user_model().objects.get(id=kwargs.get('user_id'))
+            room_ids = user.rooms.values_list('id', flat=True)
+
+        return [TransferType(debtor=debtor, creditor=creditor, amount=amount)
+                for debtor, creditor, amount in Room.consolidated_settlement(room_ids)]
+
+    def resolve_simulate_payments(self, info, **kwargs):
+        """
+            Preview of `makePayment` calls, the room is left untouched
+        """
+        if info.context.user.is_anonymous:
+            raise Exception('Not logged in!')
+        room = Room.objects.get(id=kwargs.get('room_id'))
+        payments = [(p.drawee, p.pledger, p.amount) for p in kwargs.get('payments')]
+        balances, transfers = room.simulate_payments(payments)
+        return SimulationType(
+            balances=[BalanceType(username=username, balance=balance) for username, balance in balances.items()],
+            transfers=[TransferType(debtor=debtor, creditor=creditor, amount=amount)
+                       for debtor, creditor, amount in transfers],
+        )
@@ -1,7 +1,38 @@
+import asyncio
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from importlib import import_module
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+
+import graphene
+from django.apps import apps
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from graphql_jwt.backends import JSONWebTokenBackend
+from graphql_jwt.shortcuts import get_token
 
-from payments.models import Room, Payment
+from payments import models, routers
+from payments.admin import EstimatedCountPaginator
+from payments.checks import check_shared_cache
+from payments.asgi import ASGIHandler
+from payments.backends import forget_user
+from payments.executor import PoolExecutor
+from payments.instrumentation import registry
+from payments.management.commands.importprofile import profile_imports
+from payments.models import ArchivedPayment, Room, Payment, RoomSpending, RoomStatistics
+from payments.utils import engine, engineTrace, export, importer, ledger, responseCache
+from payments.utils.optimization import Optimization
 
 
 # Create your tests here.
@@ -13,15 +44,15 @@ class TestRoomsModel(TestCase):
 
     def test_add_user(self):
         room = Room.create_room("test")
-        user = User(username="t_user", password="test", email="test@test.test")
-        user2 = User(username="t_user2", password="test", email="test@test.test")
+        user = models.User(username="t_user", password="test", email="test@test.test")
+        user2 = models.User(username="t_user2", password="test", email="test@test.test")
         user.save()
         user2.save()
         room.add_user(user)
-        self.assertEqual(room.matrix, '{"t_user":{"t_user":0.0}}')
+        id, id2 = str(user.id), str(user2.id)
+        self.assertEqual(json.loads(room.matrix), {id: {id: 0.0}})
         room.add_user(user2)
-        self.assertEqual(room.matrix, '{"t_user":{"t_user":0.0,"t_user2":0.0},'
-                                      '"t_user2":{"t_user":0.0,"t_user2":0.0}}')
+        self.assertEqual(json.loads(room.matrix), {id: {id: 0.0, id2: 0.0}, id2: {id: 0.0, id2: 0.0}})
 
 
 class TestPayments(TestCase):
@@ -155,3 +186,1056 @@ class TestPayments(TestCase):
     #     executed = client.execute(createOrderMutation, context={"headers": {"Authorization": "JWT "+token}})
     #
     #     self.assertEqual(executed['data']['users'][0]['username'], "test")
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_TIMEOUT=300)
+class TestResponseCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.create_room("test_cache")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.room.add_user(self.user)
+        self.auth = 'JWT ' + get_token(self.user)
+        self.body = json.dumps({
+            'query': 'query ($roomId: String) { room(roomId: $roomId) { matrix } }',
+            'variables': {'roomId': str(self.room.id)},
+        })
+
+    def query(self, **headers):
+        return self.client.post('/graphql/', self.body, content_type='application/json',
+                                HTTP_AUTHORIZATION=self.auth, **headers)
+
+    def test_not_modified(self):
+        response = self.query()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.query(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_invalidated_by_room_change(self):
+        etag = self.query()['ETag']
+
+        user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.room.add_user(user2)
+
+        response = self.query(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('t_user2', response.json()['data']['room']['matrix'])
+
+    def test_invalidated_by_balance_change_in_other_room(self):
+        body = json.dumps({
+            'query': 'query ($roomId: String) { me { balance } room(roomId: $roomId) { name } }',
+            'variables': {'roomId': str(self.room.id)},
+        })
+        etag = self.client.post('/graphql/', body, content_type='application/json',
+                                HTTP_AUTHORIZATION=self.auth)['ETag']
+
+        other = Room.create_room("other")
+        user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        other.add_users([self.user, user2])
+        Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=other.id, amount=-10.0, name="a")
+
+        response = self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth,
+                                    HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['me']['balance'], 10.0)
+
+    def test_mixed_operation_invalidated_by_other_room(self):
+        body = json.dumps({
+            'query': 'query ($roomId: String) { room(roomId: $roomId) { name } getRooms { name totalBalance } }',
+            'variables': {'roomId': str(self.room.id)},
+        })
+        other = Room.create_room("other")
+        user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.user.add_user_to_room(other.id)
+        user2.add_user_to_room(other.id)
+        self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        scoped = self.query()['ETag']
+
+        Payment.create_payment(drawee="t_user2", pledger="t_user2", room_id=other.id, amount=-10.0, name="a")
+
+        response = self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        rooms = {room['name']: room['totalBalance'] for room in response.json()['data']['getRooms']}
+        self.assertEqual(rooms['other'], 10.0)
+        # reads of the room alone are not invalidated by other rooms
+        self.assertEqual(self.query(HTTP_IF_NONE_MATCH=scoped).status_code, 304)
+
+    def test_invalidated_by_payment_delete(self):
+        user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        payment = Payment.objects.create(drawee=self.user, pledger=user2, room=self.room, amount=-1.0, name="a")
+        etag = self.query()['ETag']
+
+        Payment.delete_payment(payment.id)
+        self.assertEqual(self.query(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_shared_cache_required(self):
+        self.assertEqual([e.id for e in check_shared_cache(None)], ['payments.E001'])
+        with override_settings(GRAPHQL_RESPONSE_CACHE_TIMEOUT=0):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_mutation_not_cached(self):
+        body = json.dumps({'query': 'mutation { createRoom(name: "other") { room { name } } }'})
+        response = self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_TIMEOUT=0, JWT_USER_CACHE_TIMEOUT=60)
+class TestAuthentication(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def query(self, query):
+        return self.client.post('/graphql/', json.dumps({'query': query}), content_type='application/json',
+                                HTTP_AUTHORIZATION=self.auth)
+
+    def test_token_resolved_once_per_request(self):
+        self.user.delete()
+        # the revocation check, one lookup by the JWT backend and one by the model backend, not repeated per resolver
+        with self.assertNumQueries(3):
+            response = self.query('{ me { id } users { id } }')
+        self.assertEqual(len(response.json()['errors']), 2)
+
+    def test_cached_user_snapshot(self):
+        self.query('{ me { username } }')
+        with self.assertNumQueries(0):
+            response = self.query('{ me { username } }')
+        self.assertEqual(response.json()['data']['me']['username'], "t_user")
+
+    def test_snapshot_invalidated_on_user_change(self):
+        self.query('{ me { username } }')
+        self.user.set_password("changed")
+        self.user.save()
+        # the revocation check, the lookup and the reload of the snapshot
+        with self.assertNumQueries(3):
+            self.query('{ me { username } }')
+
+    def test_user_changed_while_authenticating(self):
+        authenticate = JSONWebTokenBackend.authenticate
+
+        def changed_meanwhile(backend, request=None, **kwargs):
+            user = authenticate(backend, request, **kwargs)
+            models.User.objects.filter(id=user.id).update(first_name="changed")
+            forget_user(user.id)
+            return user
+
+        with mock.patch.object(JSONWebTokenBackend, 'authenticate', changed_meanwhile):
+            self.query('{ me { firstName } }')
+        response = self.query('{ me { firstName } }')
+
+        self.assertEqual(response.json()['data']['me']['firstName'], "changed")
+
+    def test_logout_revokes_token(self):
+        self.assertEqual(self.query('mutation { logout { message } }').json()['data']['logout']['message'], "Logged out")
+
+        response = self.query('{ me { username } }')
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['errors'][0]['message'], 'Token is revoked')
+        self.assertEqual(models.RevokedToken.objects.count(), 1)
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_TIMEOUT=0, GRAPHQL_METRICS_SAMPLE_RATE=1.0, GRAPHQL_METRICS_EXTENSIONS=True,
+                   GRAPHQL_METRICS_OPERATIONS=['Test'], METRICS_TOKEN='metrics')
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.room = Room.create_room("test_metrics")
+        self.room.add_user(self.user)
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def query(self, query, variables=None, operation_name='Test'):
+        body = json.dumps({'query': query, 'variables': variables, 'operationName': operation_name})
+        return self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+
+    def test_extensions(self):
+        response = self.query('query Test($roomId: String) { room(roomId: $roomId) { name } }',
+                              {'roomId': str(self.room.id)})
+        timing = response.json()['extensions']['timing']
+        self.assertGreaterEqual(timing['sqlQueries'], 1)
+        self.assertEqual(timing['resolvers']['Query.room']['count'], 1)
+        self.assertEqual(timing['resolvers']['Query.room']['sqlQueries'], 1)
+
+    def test_metrics_endpoint(self):
+        self.query('query Test { me { username } }')
+        self.query('query Random1 { me { username } }', operation_name='Random1')
+        content = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer metrics').content.decode()
+        self.assertIn('fannypack_operation_seconds_count{operation="Test"} 1.0', content)
+        self.assertIn('fannypack_operation_seconds_count{operation="other"} 1.0', content)
+        self.assertNotIn('Random1', content)
+        self.assertIn('fannypack_resolver_seconds_count{field="Query.me"} 2.0', content)
+
+    def test_metrics_restricted(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+
+@override_settings(ENGINE_TRACE_SAMPLE_RATE=1.0)
+class TestEngineTrace(SimpleTestCase):
+    def setUp(self):
+        self.op = Optimization(room_id='r1')
+        self.op.create_matrix(['t1', 't2'])
+        self.op.add_payment('t1', 't2', -100)
+
+    def test_run_traced(self):
+        with self.assertLogs('payments.engine', 'INFO') as logs:
+            self.op.run()
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].engine['users'], 2)
+        self.assertEqual(logs.records[0].engine['transfers'], 1)
+
+    def test_enabled_by_default_logging(self):
+        # no assertLogs, the level of the logger comes from LOGGING
+        self.assertTrue(engineTrace.should_trace())
+
+    @override_settings(ENGINE_TRACE_MATRIX_ROOMS=['r1'])
+    def test_matrix_dump_for_listed_room(self):
+        with self.assertLogs('payments.engine', 'INFO') as logs:
+            self.op.run()
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('summarized matrix', logs.output[0])
+
+
+class TestLazyEngine(SimpleTestCase):
+    def test_engine_not_imported_at_startup(self):
+        seconds, loaded, rows = profile_imports(['fannypack.wsgi', 'fannypack.urls'])
+        self.assertIn('payments.models', loaded)
+        self.assertNotIn('payments.utils.optimization', loaded)
+        self.assertNotIn('pandas', loaded)
+
+    def test_engine_class_exposed(self):
+        self.assertIs(engine.Optimization, Optimization)
+        self.assertIsInstance(engine.Optimization(), Optimization)
+
+
+class TestRoomStatistics(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_statistics")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.room.add_user(self.user)
+        self.room.add_user(self.user2)
+
+    def pay(self, amount):
+        return Payment.create_payment(drawee=self.user.username, pledger=self.user2.username,
+                                      room_id=self.room.id, amount=amount, name="test_payment")
+
+    def statistics(self):
+        return {s.user.username: (s.paid, s.owed, s.payments_count)
+                for s in RoomStatistics.objects.filter(room=self.room).select_related('user')}
+
+    def test_payments_accounted(self):
+        self.pay(-125.0)
+        self.pay(-25.0)
+
+        self.assertEqual(self.statistics(), {'t_user': (150.0, 0.0, 2), 't_user2': (0.0, 150.0, 2)})
+        month = RoomSpending.objects.get(room=self.room, period=RoomSpending.MONTH)
+        self.assertEqual((month.amount, month.payments_count), (150.0, 2))
+
+    def test_deleted_payment_taken_back(self):
+        self.pay(-100.0)
+        outcome = self.pay(-125.0)
+        Payment.delete_payment_keep_integrity(outcome['payment'].id)
+
+        self.assertEqual(self.statistics(), {'t_user': (100.0, 0.0, 1), 't_user2': (0.0, 100.0, 1)})
+        day = RoomSpending.objects.get(room=self.room, period=RoomSpending.DAY)
+        self.assertEqual((day.amount, day.payments_count), (100.0, 1))
+
+
+class TestRoomLeaderboard(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_leaderboard")
+        self.users = [models.User.objects.create_user(username="t_user{}".format(i), password="test",
+                                                      email="test@test.test") for i in range(3)]
+        for user in self.users:
+            self.room.add_user(user)
+
+    def pay(self, drawee, pledger, amount):
+        return Payment.create_payment(drawee=drawee.username, pledger=pledger.username,
+                                      room_id=self.room.id, amount=amount, name="test_payment")
+
+    def test_ordered_by_balance(self):
+        self.pay(self.users[0], self.users[1], -100.0)
+        self.pay(self.users[0], self.users[2], -30.0)
+
+        debtors = [s.user.username for s in RoomStatistics.debtors(self.room.id, 10)]
+        creditors = [(s.user.username, s.balance) for s in RoomStatistics.creditors(self.room.id, 10)]
+        self.assertEqual(debtors, ['t_user1', 't_user2'])
+        self.assertEqual(creditors, [('t_user0', 130.0)])
+        self.assertEqual(RoomStatistics.rank(self.room.id, self.users[2].id), 2)
+        self.assertEqual(Room.objects.get(id=self.room.id).biggest_pledger, 't_user1')
+
+    def test_members_without_payments_ranked(self):
+        self.pay(self.users[0], self.users[1], -100.0)
+
+        with self.assertNumQueries(2):
+            ranks = [RoomStatistics.rank(self.room.id, self.users[2].id)]
+        ranks += [RoomStatistics.rank(self.room.id, user.id) for user in self.users[:2]]
+        self.assertEqual(ranks, [2, 3, 1])
+        self.assertEqual(RoomStatistics.objects.filter(room=self.room).count(), 3)
+
+    def test_settled_room_has_no_pledger(self):
+        outcome = self.pay(self.users[0], self.users[1], -100.0)
+        Payment.delete_payment_keep_integrity(outcome['payment'].id)
+
+        self.assertEqual(list(RoomStatistics.debtors(self.room.id, 10)), [])
+        self.assertEqual(Room.objects.get(id=self.room.id).biggest_pledger, '')
+
+
+class TestConsolidatedSettlement(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.rooms = [Room.create_room("test_consolidated{}".format(i)) for i in range(2)]
+        for room in self.rooms:
+            self.user.add_user_to_room(room.id)
+            self.user2.add_user_to_room(room.id)
+
+        Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.rooms[0].id, amount=-100.0, name="a")
+        Payment.create_payment(drawee="t_user2", pledger="t_user", room_id=self.rooms[1].id, amount=-40.0, name="b")
+
+    def test_rooms_netted(self):
+        transfers = Room.consolidated_settlement([room.id for room in self.rooms])
+        self.assertEqual(transfers, [('t_user2', 't_user', 60.0)])
+
+    def test_query_defaults_to_callers_rooms(self):
+        body = json.dumps({'query': '{ consolidatedSettlement { debtor creditor amount } }'})
+        response = self.client.post('/graphql/', body, content_type='application/json',
+                                    HTTP_AUTHORIZATION='JWT ' + get_token(self.user))
+        self.assertEqual(json.loads(response.content)['data']['consolidatedSettlement'],
+                         [{'debtor': 't_user2', 'creditor': 't_user', 'amount': 60.0}])
+
+
+class TestSimulatePayments(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_simulation")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.user.add_user_to_room(self.room.id)
+        self.user2.add_user_to_room(self.room.id)
+        Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.room.id, amount=-100.0, name="a")
+
+    def test_room_untouched(self):
+        room = Room.objects.get(id=self.room.id)
+        body = json.dumps({
+            'query': 'query Simulate($roomId: String!, $payments: [PaymentInput]!) {'
+                     ' simulatePayments(roomId: $roomId, payments: $payments) {'
+                     ' balances { username balance } transfers { debtor creditor amount } } }',
+            'variables': {'roomId': str(self.room.id),
+                          'payments': [{'drawee': 't_user2', 'pledger': 't_user', 'amount': -30.0}]},
+        })
+        response = self.client.post('/graphql/', body, content_type='application/json',
+                                    HTTP_AUTHORIZATION='JWT ' + get_token(self.user))
+        simulation = json.loads(response.content)['data']['simulatePayments']
+
+        self.assertEqual(simulation['transfers'], [{'debtor': 't_user2', 'creditor': 't_user', 'amount': 70.0}])
+        self.assertIn({'username': 't_user', 'balance': 70.0}, simulation['balances'])
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Room.objects.get(id=self.room.id).matrix, room.matrix)
+
+
+class TestExport(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_export")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.user.add_user_to_room(self.room.id)
+        self.user2.add_user_to_room(self.room.id)
+        for amount in (-10.0, -20.0, -30.0):
+            Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.room.id, amount=amount, name="a")
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def test_csv(self):
+        response = self.client.get('/rooms/{}/payments/'.format(self.room.id), HTTP_AUTHORIZATION=self.auth)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(lines[0], 'id,date,name,amount,drawee,pledger')
+        self.assertEqual([line.split(',')[3] for line in lines[1:]], ['-10.0', '-20.0', '-30.0'])
+
+    def test_ndjson_balances(self):
+        rows = [json.loads(line) for line in export.export(self.room.id, 'balances', 'ndjson')]
+        self.assertEqual([(row['username'], row['balance']) for row in rows], [('t_user', 60.0), ('t_user2', -60.0)])
+
+    def test_not_logged_in(self):
+        response = self.client.get('/rooms/{}/payments/'.format(self.room.id))
+        self.assertEqual(response.status_code, 401)
+
+    @skipUnless(find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_arrow_batches(self):
+        import pyarrow as pa
+
+        chunks = list(export.export(self.room.id, 'payments', 'arrow', chunk_size=2))
+        table = pa.ipc.open_stream(b''.join(chunks)).read_all()
+
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(table.column('amount').to_pylist(), [-10.0, -20.0, -30.0])
+
+
+class TestImport(TestCase):
+    users = [{'username': 't_user', 'email': 'test@test.test', 'password': 'test'},
+             {'username': 't_user2', 'email': 'test@test.test', 'password': 'test'}]
+    rooms = [{'name': 'test_import', 'secret': ''}]
+    members = [{'room': 'test_import', 'username': 't_user'}, {'room': 'test_import', 'username': 't_user2'}]
+    payments = [
+        {'room': 'test_import', 'drawee': 't_user', 'pledger': 't_user2', 'amount': '-100', 'name': 'a',
+         'date': '2019-01-31T10:00:00Z'},
+        {'room': 'test_import', 'drawee': 't_user2', 'pledger': 't_user', 'amount': '-30', 'name': 'b',
+         'date': '2019-02-01T10:00:00Z'},
+    ]
+
+    def test_import(self):
+        counts = importer.run(users=self.users, rooms=self.rooms, members=self.members, payments=self.payments,
+                              batch_size=1)
+        room = Room.objects.get(name='test_import')
+        op = Optimization()
+        op.load_from_json(room.matrix)
+
+        self.assertEqual((counts['users'], counts['members'], counts['payments']), (2, 2, 2))
+        user, user2 = models.User.objects.get(username='t_user'), models.User.objects.get(username='t_user2')
+        self.assertEqual(op.get_balances(), {user.id: 70.0, user2.id: -70.0})
+        self.assertEqual(op.get_transfers(), [(user2.id, user.id, 70.0)])
+        self.assertEqual((room.total_balance, room.biggest_pledger), (130.0, 't_user2'))
+        self.assertEqual(RoomStatistics.objects.get(room=room, user__username='t_user').balance, 70.0)
+        self.assertEqual(RoomSpending.objects.filter(room=room, period=RoomSpending.MONTH).count(), 2)
+        self.assertEqual(str(Payment.objects.get(name='a').date.date()), '2019-01-31')
+        self.assertEqual(models.User.objects.get(username='t_user').balance, 70)
+        self.assertTrue(self.client.login(username='t_user', password='test'))
+
+    def test_blank_password_unusable(self):
+        users = [{'username': 't_user', 'email': 'test@test.test', 'password': ''}, {'username': 't_user2'}]
+        importer.run(users=users)
+
+        self.assertFalse(any(user.has_usable_password() for user in models.User.objects.all()))
+        self.assertFalse(self.client.login(username='t_user', password=''))
+
+    def test_users_hashed_per_batch(self):
+        pulled, hashed = [], []
+        hash_passwords = importer.Importer.hash_passwords
+
+        def users():
+            for record in self.users:
+                pulled.append(record['username'])
+                yield record
+
+        def hash_batch(self, passwords):
+            hashed.append((len(pulled), len(passwords)))
+            return hash_passwords(self, passwords)
+
+        with mock.patch.object(importer.Importer, 'hash_passwords', hash_batch):
+            counts = importer.run(users=users(), batch_size=1)
+
+        self.assertEqual(hashed, [(1, 1), (2, 1)])
+        self.assertEqual(counts['users'], 2)
+        self.assertTrue(self.client.login(username='t_user2', password='test'))
+
+    def test_cached_users_forgotten(self):
+        with mock.patch('payments.utils.importer.forget_user') as forget_user:
+            importer.run(users=self.users, rooms=self.rooms, members=self.members, payments=self.payments)
+
+        self.assertEqual({call[0][0] for call in forget_user.call_args_list},
+                         set(models.User.objects.values_list('id', flat=True)))
+
+    def test_failed_import_rolled_back(self):
+        payments = self.payments + [{'room': 'test_import', 'drawee': 'nobody', 'pledger': 't_user', 'amount': '-1'}]
+        with self.assertRaises(Exception):
+            importer.run(users=self.users, rooms=self.rooms, members=self.members, payments=payments)
+        self.assertFalse(Room.objects.filter(name='test_import').exists())
+
+    def test_admin_upload(self):
+        models.User.objects.create_superuser(username="t_admin", password="test", email="test@test.test")
+        self.client.login(username='t_admin', password='test')
+        users = SimpleUploadedFile('users.csv', b'username,email,password\nt_user,test@test.test,test\n')
+
+        response = self.client.post('/admin/payments/room/import/', {'users': users})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(models.User.objects.filter(username='t_user').exists())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=10)
+class TestReplicaRouting(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.auth = 'JWT ' + get_token(self.user)
+        self.router = routers.ReplicaRouter()
+
+    def test_router(self):
+        self.assertEqual(self.router.db_for_read(Room), 'default')
+        with routers.read_from_replica():
+            self.assertEqual(self.router.db_for_read(Room), 'replica')
+            self.assertEqual(self.router.db_for_write(Room), 'default')
+            with transaction.atomic():
+                self.assertEqual(self.router.db_for_read(Room), 'default')
+        with routers.read_from_replica(enabled=False):
+            self.assertEqual(self.router.db_for_read(Room), 'default')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=10, GRAPHQL_RESPONSE_CACHE_TIMEOUT=300)
+class TestReplicaDatabase(TransactionTestCase):
+    """
+        Runs against a real `replica` alias of the test database, like the ones POSTGRES_REPLICA_HOSTS adds.
+        `override_settings(DATABASES=...)` doesn't reach the connection handler, the alias is registered directly.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        connections.databases['replica'] = dict(connections['default'].settings_dict, TEST={'MIRROR': 'default'})
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def post(self, query, variables=None):
+        body = json.dumps({'query': query, 'variables': variables})
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.post('/graphql/', body, content_type='application/json',
+                                        HTTP_AUTHORIZATION=self.auth)
+        aliases = {alias for alias, queries in (('default', primary), ('replica', replica))
+                   if any('"payments_room"' in q['sql'] for q in queries)}
+        return response, aliases
+
+    def test_reads_stick_to_primary_after_mutation(self):
+        self.assertEqual(self.post('{ getRooms { id } }')[1], {'replica'})
+        self.post('mutation { createRoom(name: "test", secret: "") { room { id } } }')
+        self.assertEqual(self.post('{ getRooms { name } }')[1], {'default'})
+
+    def test_replica_reads_after_change_not_cached(self):
+        Room.create_room("test").add_user(self.user)
+
+        response, aliases = self.post('{ getRooms { name } }')
+        self.assertEqual(aliases, {'replica'})
+        self.assertFalse(response.has_header('ETag'))
+
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            response, aliases = self.post('{ getRooms { name } }')
+        self.assertEqual(aliases, {'replica'})
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_replica_reads_cached_after_change_elsewhere(self):
+        with mock.patch.object(responseCache.time, 'time', return_value=time.time() - 60):
+            room = Room.create_room("test").add_user(self.user)
+        other = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        Room.create_room("other").add_user(other)
+
+        response, aliases = self.post('query ($roomId: String) { room(roomId: $roomId) { name } }',
+                                      {'roomId': str(room.id)})
+        self.assertEqual(aliases, {'replica'})
+        self.assertTrue(response.has_header('ETag'))
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_archive")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.user.add_user_to_room(self.room.id)
+        self.user2.add_user_to_room(self.room.id)
+        for amount in (-10.0, -20.0, -30.0):
+            Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.room.id, amount=amount, name="a")
+        Payment.objects.exclude(amount=-30.0).update(date=timezone.now() - timedelta(days=400))
+
+    def test_old_payments_archived(self):
+        matrix = Room.objects.get(id=self.room.id).matrix
+        archived = ArchivedPayment.archive(timezone.now() - timedelta(days=365), batch_size=1)
+
+        self.assertEqual(archived, 2)
+        self.assertEqual(list(Payment.objects.values_list('amount', flat=True)), [-30.0])
+        self.assertEqual(sorted(ArchivedPayment.objects.values_list('amount', flat=True)), [-20.0, -10.0])
+        self.assertEqual(Room.objects.get(id=self.room.id).matrix, matrix)
+        self.assertEqual(len(list(export.rows(self.room.id, 'archive'))), 2)
+
+    def test_user_deletion_uses_indexes(self):
+        ArchivedPayment.archive(timezone.now() - timedelta(days=365))
+
+        self.assertTrue(all(ArchivedPayment._meta.get_field(name).db_index for name in ('drawee', 'pledger')))
+        self.user2.delete()
+        self.assertFalse(ArchivedPayment.objects.exists())
+
+
+class TestLedgerVerification(TestCase):
+    def setUp(self):
+        self.rooms = [Room.create_room("test_ledger{}".format(i)) for i in range(3)]
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        for room in self.rooms:
+            self.user.add_user_to_room(room.id)
+            self.user2.add_user_to_room(room.id)
+            Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=room.id, amount=-10.0, name="a")
+        ArchivedPayment.archive(timezone.now(), batch_size=2)
+        Payment.create_payment(drawee="t_user2", pledger="t_user", room_id=self.rooms[0].id, amount=-4.0, name="b")
+
+    def test_consistent_rooms(self):
+        results = ledger.verify(shards=4)
+        self.assertEqual(sum(stats['rooms'] for stats in results), 3)
+        self.assertEqual(sum(stats['payments'] for stats in results), 4)
+        self.assertEqual([room for stats in results for room in stats['drifted']], [])
+
+    def test_drift_repaired(self):
+        Payment.objects.create(drawee=self.user, pledger=self.user2, room=self.rooms[1], amount=-5.0, name="c")
+
+        results = ledger.verify(shards=2, repair=True)
+        op = Optimization()
+        op.load_from_json(Room.objects.get(id=self.rooms[1].id).matrix)
+
+        self.assertEqual([room for stats in results for room, _ in stats['drifted']], [str(self.rooms[1].id)])
+        self.assertEqual(op.get_balances(), {self.user.id: 15.0, self.user2.id: -15.0})
+        self.assertEqual([room for stats in ledger.verify(shards=2) for room in stats['drifted']], [])
+
+    def test_repair_recomputes_accounting(self):
+        room = self.rooms[1]
+        balances = dict(models.User.objects.values_list('id', 'balance'))
+        Payment.objects.create(drawee=self.user, pledger=self.user2, room=room, amount=-5.0, name="c")
+
+        ledger.repair_room(room.id)
+        room = Room.objects.get(id=room.id)
+        statistics = {row.user_id: row for row in RoomStatistics.objects.filter(room=room)}
+
+        self.assertEqual(room.total_balance, 15.0)
+        self.assertEqual(room.biggest_pledger, "t_user2")
+        self.assertEqual((statistics[self.user.id].paid, statistics[self.user.id].balance), (15.0, 15.0))
+        self.assertEqual((statistics[self.user2.id].owed, statistics[self.user2.id].balance), (15.0, -15.0))
+        self.assertEqual(statistics[self.user2.id].payments_count, 2)
+        self.assertEqual(RoomSpending.objects.get(room=room, period=RoomSpending.DAY).amount, 15.0)
+        self.assertEqual(models.User.objects.get(id=self.user.id).balance, balances[self.user.id] + 5)
+        self.assertEqual(models.User.objects.get(id=self.user2.id).balance, balances[self.user2.id] - 5)
+
+        # a second repair finds nothing to change
+        ledger.repair_room(room.id)
+        self.assertEqual(models.User.objects.get(id=self.user.id).balance, balances[self.user.id] + 5)
+
+    def test_statistics_drift_detected(self):
+        RoomStatistics.objects.filter(room=self.rooms[2], user=self.user).update(balance=3.0)
+
+        drifted = [room for stats in ledger.verify(shards=3, repair=True) for room, _ in stats['drifted']]
+
+        self.assertEqual(drifted, [str(self.rooms[2].id)])
+        self.assertEqual(RoomStatistics.objects.get(room=self.rooms[2], user=self.user).balance, 10.0)
+
+
+class TestCompactEncoding(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_encoding")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.user.add_user_to_room(self.room.id)
+        self.user2.add_user_to_room(self.room.id)
+        Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.room.id, amount=-10.0, name="a")
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def query(self, encoding, **headers):
+        body = json.dumps({'query': '{ room(roomId: "%s") { matrix(encoding: "%s") } }' % (self.room.id, encoding)})
+        return self.client.post('/graphql/', body, content_type='application/json', HTTP_AUTHORIZATION=self.auth,
+                                **headers)
+
+    def test_encodings(self):
+        dense = json.loads(json.loads(self.query('dense').content)['data']['room']['matrix'])
+        sparse = json.loads(json.loads(self.query('sparse').content)['data']['room']['matrix'])
+
+        self.assertEqual(dense, {'users': ['t_user', 't_user2'], 'values': [10.0, -10.0, 0.0, 0.0]})
+        self.assertEqual(sparse, {'users': ['t_user', 't_user2'], 'cells': [[0, 0, 10.0], [0, 1, -10.0]]})
+
+    def test_keyed_by_user_id(self):
+        body = json.dumps({'query': '{ room(roomId: "%s") { matrix(userIds: true) } }' % self.room.id})
+        by_id = json.loads(json.loads(self.client.post('/graphql/', body, content_type='application/json',
+                                                       HTTP_AUTHORIZATION=self.auth).content)['data']['room']['matrix'])
+        self.assertEqual(by_id[str(self.user2.id)], {str(self.user.id): -10.0, str(self.user2.id): 0.0})
+
+        self.user2.username = 't_renamed'
+        self.user2.save()
+        sparse = json.loads(json.loads(self.query('sparse').content)['data']['room']['matrix'])
+        self.assertEqual(sparse['users'], ['t_user', 't_renamed'])
+
+    def test_usernames_looked_up_once(self):
+        for i in range(4):
+            room = Room.create_room("test_encoding{}".format(i))
+            user = models.User.objects.create_user(username="t_other{}".format(i), password="test",
+                                                   email="test@test.test")
+            room.add_users([self.user, user])
+        body = json.dumps({'query': '{ getRooms { name matrix } }'})
+
+        # authentication (revocation check and user), the rooms and the usernames of all their members
+        with self.assertNumQueries(4):
+            rooms = json.loads(self.client.post('/graphql/', body, content_type='application/json',
+                                                HTTP_AUTHORIZATION=self.auth).content)['data']['getRooms']
+
+        matrices = {room['name']: json.loads(room['matrix']) for room in rooms}
+        self.assertEqual(len(matrices), 5)
+        self.assertEqual(sorted(matrices['test_encoding3']), ['t_other3', 't_user'])
+
+    @override_settings(GRAPHQL_COMPRESSION_MIN_BYTES=10, GRAPHQL_RESPONSE_CACHE_TIMEOUT=300)
+    def test_gzip_negotiated(self):
+        plain = self.query('nested')
+        response = self.query('nested', HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertTrue(response['ETag'].startswith('W/'))
+
+
+class TestLargeUserIds(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_large_ids")
+        # ids above a year in seconds, pandas would read them as timestamps
+        self.users = [models.User.objects.create_user(id=40000001 + i, username="t_user{}".format(i), password="test",
+                                                      email="test@test.test") for i in range(2)]
+        for user in self.users:
+            user.add_user_to_room(self.room.id)
+
+    def test_payment_round_trip(self):
+        Payment.create_payment(drawee="t_user0", pledger="t_user1", room_id=self.room.id, amount=-10.0, name="a")
+        Payment.create_payment(drawee="t_user1", pledger="t_user0", room_id=self.room.id, amount=-4.0, name="b")
+
+        op = Optimization()
+        op.load_from_json(Room.objects.get(id=self.room.id).matrix)
+
+        self.assertEqual(op.get_balances(), {40000001: 6.0, 40000002: -6.0})
+
+    def test_matrix_migration(self):
+        migration = import_module('payments.migrations.0005_matrix_user_ids')
+        Room.objects.filter(id=self.room.id).update(matrix=json.dumps({'t_user0': {'t_user0': 0.0, 't_user1': -1.0},
+                                                                       't_user1': {'t_user0': 1.0, 't_user1': 0.0}}))
+
+        migration.usernames_to_ids(apps, None)
+        by_id = Room.objects.get(id=self.room.id).matrix
+        op = Optimization()
+        op.load_from_json(by_id)
+        self.assertEqual(sorted(op.matrix.index), [40000001, 40000002])
+        self.assertEqual(json.loads(by_id)['40000002'], {'40000001': 1.0, '40000002': 0.0})
+
+        migration.ids_to_usernames(apps, None)
+        self.assertEqual(json.loads(Room.objects.get(id=self.room.id).matrix)['t_user1'],
+                         {'t_user0': 1.0, 't_user1': 0.0})
+
+
+class TestPoolExecutor(SimpleTestCase):
+    class Query(graphene.ObjectType):
+        first = graphene.String()
+        second = graphene.String()
+        failing = graphene.String()
+
+        def resolve_first(self, info):
+            time.sleep(0.2)
+            return threading.current_thread().name
+
+        def resolve_second(self, info):
+            time.sleep(0.2)
+            return threading.current_thread().name
+
+        def resolve_failing(self, info):
+            raise Exception('failed')
+
+    def test_root_fields_concurrent(self):
+        schema = graphene.Schema(query=self.Query)
+        started = time.perf_counter()
+        result = schema.execute('{ first second failing }', executor=PoolExecutor(ThreadPoolExecutor(2)))
+        elapsed = time.perf_counter() - started
+
+        self.assertLess(elapsed, 0.35)
+        self.assertNotEqual(result.data['first'], result.data['second'])
+        self.assertIsNone(result.data['failing'])
+        self.assertEqual([str(e) for e in result.errors], ['failed'])
+
+    def test_connections_checked_once_per_request(self):
+        schema = graphene.Schema(query=self.Query)
+        pool = ThreadPoolExecutor(1)
+        with mock.patch('payments.executor.close_old_connections') as close:
+            schema.execute('{ first second failing }', executor=PoolExecutor(pool))
+            self.assertEqual(close.call_count, 1)
+            schema.execute('{ first second }', executor=PoolExecutor(pool))
+            self.assertEqual(close.call_count, 2)
+
+
+class TestASGI(SimpleTestCase):
+    def serve(self, application, send, disconnected=None, path='/', headers=()):
+        messages = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # like a server, the next message comes when the client goes away
+            await (disconnected or asyncio.Event()).wait()
+            return {'type': 'http.disconnect'}
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+                 'headers': [(b'host', b'localhost')] + list(headers)}
+        asyncio.get_event_loop().run_until_complete(ASGIHandler(application, threads=2)(scope, receive, send))
+
+    def request(self, path, headers=()):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        self.serve(get_wsgi_application(), send, path=path, headers=headers)
+        return sent
+
+    def streaming(self):
+        response = {'produced': 0, 'closed': False}
+
+        class Body:
+            def __iter__(self):
+                for _ in range(1000):
+                    response['produced'] += 1
+                    yield b'x'
+
+            def close(self):
+                response['closed'] = True
+
+        def application(environ, start_response):
+            start_response('200 OK', [])
+            return Body()
+
+        return application, response
+
+    def test_send_failure_stops_response(self):
+        application, response = self.streaming()
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                raise OSError('connection reset')
+
+        with self.assertRaises(OSError):
+            self.serve(application, send)
+
+        self.assertTrue(response['closed'])
+        self.assertLess(response['produced'], 1000)
+
+    def test_client_disconnect_mid_stream(self):
+        application, response = self.streaming()
+        disconnected = asyncio.Event()
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body':
+                disconnected.set()
+                await asyncio.sleep(0.01)
+
+        self.serve(application, send, disconnected)
+
+        self.assertTrue(response['closed'])
+        self.assertLess(response['produced'], 1000)
+        self.assertTrue(sent[-1].get('more_body'))
+
+    @override_settings(METRICS_TOKEN='metrics')
+    def test_django_served(self):
+        sent = self.request('/metrics/', headers=[(b'authorization', b'Bearer metrics')])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(b'fannypack_metrics_sample_rate', b''.join(m.get('body', b'') for m in sent[1:]))
+        self.assertFalse(sent[-1].get('more_body'))
+
+
+class TestAddUsersToRoom(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_members", secret="secret")
+        self.users = [models.User.objects.create_user(username="t_user{}".format(i), password="test",
+                                                      email="test@test.test") for i in range(3)]
+        self.users[0].add_user_to_room(self.room.id, "secret")
+        self.auth = 'JWT ' + get_token(self.users[0])
+
+    def mutate(self, usernames, secret):
+        body = json.dumps({
+            'query': 'mutation Add($roomId: String!, $usernames: [String]!, $secret: String) {'
+                     ' addUsersToRoom(roomId: $roomId, usernames: $usernames, secret: $secret) { users { username } } }',
+            'variables': {'roomId': str(self.room.id), 'usernames': usernames, 'secret': secret},
+        })
+        return json.loads(self.client.post('/graphql/', body, content_type='application/json',
+                                           HTTP_AUTHORIZATION=self.auth).content)
+
+    def test_members_added_once(self):
+        content = self.mutate(['t_user0', 't_user1', 't_user2'], 'secret')
+        room = Room.objects.get(id=self.room.id)
+
+        self.assertEqual([u['username'] for u in content['data']['addUsersToRoom']['users']], ['t_user1', 't_user2'])
+        self.assertEqual(sorted(room.user_set.values_list('username', flat=True)), ['t_user0', 't_user1', 't_user2'])
+        ids = [str(user.id) for user in self.users]
+        self.assertEqual(json.loads(room.matrix)[ids[2]], {id: 0.0 for id in ids})
+
+    def test_wrong_secret(self):
+        content = self.mutate(['t_user1'], 'wrong')
+
+        self.assertEqual(content['errors'][0]['message'], 'Incorrect password')
+        self.assertEqual(Room.objects.get(id=self.room.id).user_set.count(), 1)
+
+    def test_stale_room_locked_and_reloaded(self):
+        stale = Room.objects.get(id=self.room.id)
+        Room.objects.get(id=self.room.id).add_members(['t_user1'], 'secret')
+
+        with mock.patch.object(Room.objects, 'select_for_update', wraps=Room.objects.select_for_update) as lock:
+            stale.add_members(['t_user2'], 'secret')
+
+        lock.assert_called_once_with()
+        ids = [str(user.id) for user in self.users]
+        self.assertEqual(sorted(json.loads(Room.objects.get(id=self.room.id).matrix)), sorted(ids))
+
+
+class TestIdempotency(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.create_room("test_idempotency")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.room.add_user(self.user)
+        self.room.add_user(self.user2)
+        self.auth = 'JWT ' + get_token(self.user)
+
+    def make_payment(self, key, amount=-50.0):
+        body = json.dumps({
+            'query': 'mutation Pay($roomId: String!, $amount: Float!, $key: String) {'
+                     ' makePayment(drawee: "t_user", pledger: "t_user2", roomId: $roomId, amount: $amount,'
+                     ' name: "dinner", idempotencyKey: $key) { payment { id } } }',
+            'variables': {'roomId': str(self.room.id), 'amount': amount, 'key': key},
+        })
+        return json.loads(self.client.post('/graphql/', body, content_type='application/json',
+                                           HTTP_AUTHORIZATION=self.auth).content)
+
+    def delete_payment(self, id, key):
+        body = json.dumps({
+            'query': 'mutation Delete($id: String!, $key: String) {'
+                     ' deletePayment(id: $id, idempotencyKey: $key) { message } }',
+            'variables': {'id': id, 'key': key},
+        })
+        return json.loads(self.client.post('/graphql/', body, content_type='application/json',
+                                           HTTP_AUTHORIZATION=self.auth).content)
+
+    def test_retry_replayed(self):
+        first = self.make_payment('retry')
+        with mock.patch.object(Payment, 'create_payment') as create_payment:
+            second = self.make_payment('retry')
+
+        create_payment.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual(Payment.objects.filter(room=self.room).count(), 1)
+        self.assertEqual(RoomStatistics.objects.get(room=self.room, user=self.user).payments_count, 1)
+
+    def test_without_key(self):
+        self.make_payment(None)
+        self.make_payment(None)
+
+        self.assertEqual(Payment.objects.filter(room=self.room).count(), 2)
+
+    def test_key_reused_with_other_arguments(self):
+        self.make_payment('reused')
+        content = self.make_payment('reused', amount=-10.0)
+
+        self.assertEqual(content['errors'][0]['message'], 'Idempotency key was used with different arguments')
+        self.assertEqual(Payment.objects.filter(room=self.room).count(), 1)
+
+    def test_delete_replayed(self):
+        id = self.make_payment(None)['data']['makePayment']['payment']['id']
+        first = self.delete_payment(id, 'delete')
+        second = self.delete_payment(id, 'delete')
+
+        self.assertEqual(first, second)
+        self.assertEqual(first['data']['deletePayment']['message'], 'Payment {} was deleted'.format(id))
+        self.assertEqual(RoomStatistics.objects.get(room=self.room, user=self.user).payments_count, 0)
+
+    def test_key_stored_with_mutation(self):
+        with mock.patch.object(Payment, 'create_payment', side_effect=Exception('failed')):
+            self.make_payment('failing')
+        self.assertFalse(models.IdempotencyKey.objects.exists())
+
+        id = self.make_payment('failing')['data']['makePayment']['payment']['id']
+        key = models.IdempotencyKey.objects.get()
+        self.assertEqual((key.user_id, key.operation, key.key), (self.user.id, 'makePayment', 'failing'))
+        self.assertEqual(json.loads(key.result), id)
+
+    def test_expired_key_runs_again(self):
+        self.make_payment('expired')
+        models.IdempotencyKey.objects.update(created=timezone.now() - timedelta(days=2))
+
+        self.make_payment('expired')
+
+        self.assertEqual(Payment.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(models.IdempotencyKey.objects.count(), 1)
+        self.assertEqual(models.IdempotencyKey.purge(timezone.now() + timedelta(seconds=1)), 1)
+
+    def test_replay_of_archived_payment(self):
+        first = self.make_payment('archived')
+        ArchivedPayment.archive(timezone.now() + timedelta(seconds=1))
+
+        self.assertEqual(self.make_payment('archived'), first)
+
+    def test_replay_of_deleted_payment(self):
+        id = self.make_payment('deleted')['data']['makePayment']['payment']['id']
+        Payment.objects.filter(id=id).delete()
+
+        content = self.make_payment('deleted')
+
+        self.assertEqual(content['errors'][0]['message'], 'Payment made with this idempotency key was deleted')
+
+
+class TestAdmin(TestCase):
+    def setUp(self):
+        self.room = Room.create_room("test_admin")
+        self.user = models.User.objects.create_user(username="t_user", password="test", email="test@test.test")
+        self.user2 = models.User.objects.create_user(username="t_user2", password="test", email="test@test.test")
+        self.room.add_users([self.user, self.user2])
+        for amount in (-10.0, -20.0):
+            Payment.create_payment(drawee="t_user", pledger="t_user2", room_id=self.room.id, amount=amount, name="a")
+        models.User.objects.create_superuser(username="t_admin", password="test", email="test@test.test")
+        self.client.login(username='t_admin', password='test')
+
+    def test_changelists_skip_matrix(self):
+        for url in ('/admin/payments/room/', '/admin/payments/payment/'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse([q['sql'] for q in queries if 'matrix' in q['sql']])
+
+    def test_indexed_search(self):
+        rooms = self.client.get('/admin/payments/room/', {'q': 'test_ad'}).context['cl'].result_list
+        by_id = self.client.get('/admin/payments/room/', {'q': str(self.room.id)}).context['cl'].result_list
+        payments = self.client.get('/admin/payments/payment/', {'q': 't_user2'}).context['cl'].result_list
+
+        self.assertEqual(list(rooms), [self.room])
+        self.assertEqual(list(by_id), [self.room])
+        self.assertEqual(len(payments), 2)
+
+    def test_balance_summary(self):
+        response = self.client.get('/admin/payments/room/{}/change/'.format(self.room.id))
+
+        self.assertContains(response, '<td>t_user2 &rarr; t_user</td><td>30.00</td>', html=True)
+
+    @override_settings(ADMIN_BALANCE_SUMMARY_MEMBERS=1)
+    def test_balance_summary_bounded(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/payments/room/{}/change/'.format(self.room.id))
+
+        self.assertContains(response, 'Not shown for rooms of more than 1 members, this room has 2')
+        self.assertFalse([q['sql'] for q in queries if 'matrix' in q['sql']])
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=1000)
+    def test_estimated_count(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(EstimatedCountPaginator, 'estimate', side_effect=[5000, 10]):
+            self.assertEqual(EstimatedCountPaginator(Payment.objects.all(), 100).count, 5000)
+            self.assertEqual(EstimatedCountPaginator(Payment.objects.all(), 100).count, 2)
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=1000)
+    def test_filtered_count_exact(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(EstimatedCountPaginator, 'estimate', return_value=5000) as estimate:
+            self.assertEqual(EstimatedCountPaginator(Payment.objects.filter(room=self.room), 100).count, 2)
+
+        estimate.assert_not_called()
@@ -0,0 +1,182 @@
+import json
+import platform
+import random
+import signal
+import statistics
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from payments.utils.optimization import Optimization
+
+OPERATIONS = ['add_user', 'add_payment', 'run', 'get_biggest_pledger', 'export_to_json', 'load_from_json']
+
+# largest room each operation is timed on by default. `run()` grows roughly with the cube of the room size
+# (0.6s for 100 users, 3.5s for 200) and recurses once per transfer, rooms settling into more transfers than
+# the recursion limit (1000 by default) can't be run at all.
+DEFAULT_LIMITS = {'run': 200}
+# seconds an operation may take for all its repeats before it is reported as not measurable
+DEFAULT_TIMEOUT = 60
+
+
+class Timeout(Exception):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    """
+        Raise `Timeout` in the block after `seconds`, only where `SIGALRM` exists and on the main thread
+    """
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise Timeout()
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def synthetic_payments(users, payments_per_user, seed):
+    """
+        Yield `(drawee, pledger, amount)` triples resembling real rooms:
+            - a few members pay for most expenses (Zipf distributed payers)
+            - expenses are split between 2-8 members
+            - expense amounts are log-normally distributed
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(users))]
+
+    for _ in range(len(users) * payments_per_user):
+        drawee = rng.choices(users, weights)[0]
+        participants = rng.sample(users, min(len(users), rng.randint(2, 8)))
+        share = round(rng.lognormvariate(3, 1) / len(participants), 2)
+        for pledger in participants:
+            if pledger != drawee:
+                yield drawee, pledger, -share
+
+
+def _timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        timings.append(perf_counter() - started)
+    return statistics.median(timings)
+
+
+def _copy(op):
+    copy = Optimization()
+    copy.matrix = op.matrix.copy()
+    return copy
+
+
+def _fill(users, payments):
+    op = Optimization()
+    op.create_matrix(users)
+    for drawee, pledger, amount in payments:
+        op.add_payment(drawee, pledger, amount)
+    return op
+
+
+def benchmark_size(size, payments_per_user=5, repeat=3, seed=0, operations=OPERATIONS, limits=DEFAULT_LIMITS,
+                   timeout=DEFAULT_TIMEOUT):
+    users = ['user{}'.format(i) for i in range(size)]
+    payments = list(synthetic_payments(users, payments_per_user, seed))
+    result = {}
+
+    started = perf_counter()
+    op = _fill(users, payments)
+    elapsed = perf_counter() - started
+
+    # tracing allocations slows Python down several times, memory is measured by a separate pass
+    tracemalloc.start()
+    _fill(users, payments)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result['memory'] = {
+        'matrix_bytes': int(op.matrix.memory_usage(deep=True).sum()),
+        'peak_bytes': peak,
+    }
+
+    def record(name, func):
+        if name not in operations:
+            return
+        if size > limits.get(name, size):
+            result[name] = {'skipped': 'room larger than {}'.format(limits[name])}
+            return
+        try:
+            with deadline(timeout):
+                result[name] = {'seconds': func()}
+        except RecursionError:
+            result[name] = {'not measurable': 'recursion deeper than {} frames'.format(sys.getrecursionlimit())}
+        except Timeout:
+            result[name] = {'not measurable': 'slower than {}s'.format(timeout)}
+        except Exception as e:
+            result[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    record('add_payment', lambda: elapsed / max(len(payments), 1))
+    record('add_user', lambda: _timed(lambda: _copy(op).add_user('new-user'), repeat))
+    record('get_biggest_pledger', lambda: _timed(op.get_biggest_pledger, repeat))
+    record('run', lambda: _timed(lambda: _copy(op).run(), repeat))
+
+    exported = op.export_to_json()
+    result['json_bytes'] = len(exported)
+    record('export_to_json', lambda: _timed(op.export_to_json, repeat))
+    record('load_from_json', lambda: _timed(lambda: Optimization().load_from_json(exported), repeat))
+
+    return result
+
+
+def run_benchmark(sizes, **kwargs):
+    return {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'parameters': {k: v for k, v in kwargs.items() if k != 'limits'},
+        },
+        'results': {str(size): benchmark_size(size, **kwargs) for size in sizes},
+    }
+
+
+def compare(baseline, current, threshold=1.1):
+    """
+        Return `(size, operation, before, after, ratio, regressed)` rows for operations timed in both runs
+    """
+    rows = []
+    for size, operations in current['results'].items():
+        previous = baseline['results'].get(size, {})
+        for name in OPERATIONS:
+            before = previous.get(name, {}).get('seconds')
+            after = operations.get(name, {}).get('seconds')
+            if before is None or after is None:
+                continue
+            ratio = after / before if before else float('inf')
+            rows.append((int(size), name, before, after, ratio, ratio > threshold))
+    return rows
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
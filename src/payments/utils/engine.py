@@ -0,0 +1,26 @@
+import sys
+
+ENGINE_MODULE = 'payments.utils.optimization'
+
+
+def load():
+    """
+        Import the settlement engine, pulling in pandas and NumPy on the first call
+    """
+    from payments.utils.optimization import Optimization as engine
+    return engine
+
+
+def is_loaded():
+    return ENGINE_MODULE in sys.modules
+
+
+def __getattr__(name):
+    """
+        `engine.Optimization` is the engine class itself, imported on first access.
+        Use it as an attribute of this module: `from payments.utils.engine import Optimization`
+        would import the engine along with the importing module.
+    """
+    if name == 'Optimization':
+        return load()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,52 @@
+import logging
+import random
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger('payments.engine')
+
+
+def _setting(name, default):
+    # the engine also runs outside of Django, e.g. in its unit tests
+    if not settings.configured:
+        return default
+    return getattr(settings, name, default)
+
+
+def _level():
+    return logging.getLevelName(_setting('ENGINE_TRACE_LEVEL', 'INFO'))
+
+
+def should_trace():
+    rate = _setting('ENGINE_TRACE_SAMPLE_RATE', 0.0)
+    return rate > 0 and logger.isEnabledFor(_level()) and random.random() < rate
+
+
+def emit_run(room_id, matrix, iterations, duration):
+    values = matrix.values
+    users = len(matrix.index)
+    transfers = int(np.count_nonzero(values) - np.count_nonzero(np.diagonal(values)))
+    logger.log(
+        _level(),
+        'settlement room=%s users=%d iterations=%d transfers=%d duration=%.6f',
+        room_id, users, iterations, transfers, duration,
+        extra={'engine': {
+            'room': str(room_id) if room_id is not None else None,
+            'users': users,
+            'iterations': iterations,
+            'transfers': transfers,
+            'duration': duration,
+        }},
+    )
+
+
+def dump_matrix(room_id, stage, matrix):
+    """
+        Log the whole matrix, only for rooms listed in `ENGINE_TRACE_MATRIX_ROOMS`
+    """
+    if room_id is None or str(room_id) not in _setting('ENGINE_TRACE_MATRIX_ROOMS', []):
+        return
+    if not logger.isEnabledFor(_level()):
+        return
+    logger.log(_level(), 'settlement room=%s %s matrix\n%s', room_id, stage, matrix.to_string())
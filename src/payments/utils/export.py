@@ -0,0 +1,140 @@
+import csv
+import json
+
+from payments.models import ArchivedPayment, Payment, RoomStatistics
+
+CHUNK_SIZE = 2000
+
+TABLES = {
+    'payments': ('id', 'date', 'name', 'amount', 'drawee', 'pledger'),
+    'archive': ('id', 'date', 'name', 'amount', 'drawee', 'pledger'),
+    'balances': ('username', 'paid', 'owed', 'balance', 'payments_count'),
+}
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+
+def rows(room_id, table, chunk_size=CHUNK_SIZE):
+    """
+        Yield tuples of `TABLES[table]` fields, fetched from the database `chunk_size` rows at a time
+    """
+    if table in ('payments', 'archive'):
+        model = Payment if table == 'payments' else ArchivedPayment
+        queryset = model.objects.filter(room_id=room_id).order_by('date', 'id').values_list(
+            'id', 'date', 'name', 'amount', 'drawee__username', 'pledger__username')
+    else:
+        queryset = RoomStatistics.objects.filter(room_id=room_id).order_by('user__username').values_list(
+            'user__username', 'paid', 'owed', 'balance', 'payments_count')
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def _value(value):
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class _Echo:
+    # csv.writer only needs `write`, returning the line lets it be yielded right away
+    def write(self, value):
+        return value
+
+
+def to_csv(fields, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_value(value) for value in row])
+
+
+def to_ndjson(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, (_value(value) for value in row)))) + '\n'
+
+
+class _Buffer:
+    # file-like sink for pyarrow, the written bytes are taken out after every record batch
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _arrow_schema(pa, fields):
+    types = {
+        'id': pa.string(), 'date': pa.timestamp('us', tz='UTC'), 'name': pa.string(), 'amount': pa.float64(),
+        'drawee': pa.string(), 'pledger': pa.string(), 'username': pa.string(), 'paid': pa.float64(),
+        'owed': pa.float64(), 'balance': pa.float64(), 'payments_count': pa.int64(),
+    }
+    return pa.schema([(field, types[field]) for field in fields])
+
+
+def to_arrow(fields, rows, chunk_size=CHUNK_SIZE):
+    """
+        Apache Arrow IPC stream, one record batch per `chunk_size` rows. Readable by pandas, DuckDB or Polars.
+        Needs the optional `pyarrow` package.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise Exception('arrow export requires pyarrow')
+
+    # imported eagerly so a missing dependency fails before the response starts streaming
+    return _arrow_stream(pa, _arrow_schema(pa, fields), rows, chunk_size)
+
+
+def _arrow_stream(pa, schema, rows, chunk_size):
+    buffer = _Buffer()
+    writer = pa.ipc.new_stream(pa.PythonFile(buffer, mode='w'), schema)
+
+    def write(chunk):
+        columns = [
+            pa.array([str(v) if v is not None and field.type == pa.string() else v for v in column], type=field.type)
+            for field, column in zip(schema, zip(*chunk))
+        ]
+        writer.write_batch(pa.record_batch(columns, schema=schema))
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            write(chunk)
+            chunk = []
+            yield buffer.take()
+    if chunk:
+        write(chunk)
+    writer.close()
+    yield buffer.take()
+
+
+def export(room_id, table, format, chunk_size=CHUNK_SIZE):
+    """
+        Generator of the encoded `table` of a room, see `TABLES` and `FORMATS`
+    """
+    fields = TABLES[table]
+    data = rows(room_id, table, chunk_size)
+    if format == 'csv':
+        return to_csv(fields, data)
+    if format == 'ndjson':
+        return to_ndjson(fields, data)
+    return to_arrow(fields, data, chunk_size)
@@ -0,0 +1,52 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from payments.models import IdempotencyKey
+
+
+def _digest(arguments):
+    return hashlib.md5(json.dumps(arguments, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def expired_before():
+    return timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TIMEOUT)
+
+
+def once(user_id, operation, key, arguments, run):
+    """
+        Run `run()` once per idempotency `key` of the user, retries get the stored result back.
+        Only small JSON results are stored (ids, messages), they expire after `IDEMPOTENCY_KEY_TIMEOUT` seconds.
+        The key is claimed in the transaction of `run()`: a retry racing the first request waits for it
+        to commit and replays its result, or runs itself if the first request rolled back.
+    """
+    if not key or not settings.IDEMPOTENCY_KEY_TIMEOUT:
+        return run()
+
+    digest = _digest(arguments)
+    lookup = {'user_id': user_id, 'operation': operation, 'key': key}
+    expired = expired_before()
+    with transaction.atomic():
+        stored = IdempotencyKey.objects.filter(created__gte=expired, **lookup).first()
+        if stored is None:
+            IdempotencyKey.objects.filter(created__lt=expired, **lookup).delete()
+            try:
+                with transaction.atomic():
+                    claim = IdempotencyKey.objects.create(digest=digest, **lookup)
+            except IntegrityError:
+                # the unique insert waited for a concurrent request with the same key, which committed
+                stored = IdempotencyKey.objects.get(**lookup)
+
+        if stored is not None:
+            if stored.digest != digest:
+                raise Exception('Idempotency key was used with different arguments')
+            return json.loads(stored.result)
+
+        result = run()
+        claim.result = json.dumps(result)
+        claim.save(update_fields=['result'])
+        return result
@@ -0,0 +1,259 @@
+import csv
+import json
+import tempfile
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+from multiprocessing import Pool
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from payments.backends import forget_user
+from payments.models import Payment, Room, RoomSpending, RoomStatistics, User
+from payments.utils import engine
+from payments.utils.secretManager import hash_password
+
+BATCH_SIZE = 1000
+
+# columns of the imported files, CSV headers or keys of NDJSON records
+FIELDS = {
+    'users': ('username', 'email', 'password'),
+    'rooms': ('name', 'secret'),
+    'members': ('room', 'username'),
+    'payments': ('room', 'drawee', 'pledger', 'amount', 'name', 'date'),
+}
+
+
+def read_records(file, name):
+    """
+        Yield records of an open text file one at a time, CSV when `name` ends with `.csv`, NDJSON otherwise
+    """
+    if name.endswith('.csv'):
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Importer:
+    """
+        Bulk import of users, rooms, room members and payment history.
+            - call `import_users`, `import_rooms`, `import_members` and `import_payments` in this order,
+              then `finish()`, ideally inside one transaction, see `run`
+            - rooms are created by the import and referenced by their `name`, users by `username`
+            - every room's matrix is built once from the imported balances and settled once in `finish()`
+            - passwords are hashed by `prepare_users` before the transaction opens, with `processes` > 1
+              over a process pool, blank passwords become unusable ones. Hashed users are staged in a temporary
+              file, so neither the users nor their hashes are held in memory
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, processes=1):
+        self.batch_size = batch_size
+        self.processes = processes
+        self.rooms = {}
+        self.user_ids = {}
+        self.members = defaultdict(set)
+        self.balances = defaultdict(lambda: defaultdict(float))
+        self.totals = defaultdict(float)
+        self.statistics = defaultdict(lambda: [0.0, 0.0, 0])
+        self.spending = defaultdict(lambda: [0.0, 0])
+        self.user_balances = defaultdict(Decimal)
+        self.counts = defaultdict(int)
+
+    def hash_passwords(self, passwords):
+        if self.processes > 1 and len(passwords) > 1:
+            with Pool(self.processes) as pool:
+                return pool.map(make_password, passwords)
+        return [make_password(password) for password in passwords]
+
+    def prepare_users(self, records, staged):
+        """
+            Write records of new users with hashed passwords to the open text file `staged` as NDJSON,
+            one batch at a time, for `import_users` to read back
+        """
+        for batch in batches(records, self.batch_size):
+            existing = set(User.objects.filter(username__in=[r['username'] for r in batch])
+                           .values_list('username', flat=True))
+            self.counts['users_skipped'] += len(existing)
+            batch = [dict(record) for record in batch if record['username'] not in existing]
+            # `make_password(None)` is an unusable password, nobody logs in with an empty one
+            passwords = self.hash_passwords([record.get('password') or None for record in batch])
+            for record, password in zip(batch, passwords):
+                record['password'] = password
+                staged.write(json.dumps(record) + '\n')
+
+    def resolve_users(self, usernames):
+        missing = set(usernames) - set(self.user_ids)
+        if missing:
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        unknown = set(usernames) - set(self.user_ids)
+        if unknown:
+            raise Exception("users don't exist: {}".format(', '.join(sorted(unknown))))
+        return self.user_ids
+
+    def room(self, name):
+        try:
+            return self.rooms[name]
+        except KeyError:
+            raise Exception("room {} isn't part of the import".format(name))
+
+    def import_users(self, records):
+        for batch in batches(records, self.batch_size):
+            existing = set(User.objects.filter(username__in=[r['username'] for r in batch])
+                           .values_list('username', flat=True))
+            batch = [record for record in batch if record['username'] not in existing]
+            self.counts['users_skipped'] += len(existing)
+            User.objects.bulk_create(
+                User(username=record['username'], email=record.get('email') or '', password=record['password'])
+                for record in batch
+            )
+            self.counts['users'] += len(batch)
+
+    def import_rooms(self, records):
+        for batch in batches(records, self.batch_size):
+            rooms = []
+            for record in batch:
+                if record['name'] in self.rooms:
+                    raise Exception('room {} is listed twice'.format(record['name']))
+                secret = record.get('secret')
+                room = Room(id=uuid.uuid4(), name=record['name'], secret=hash_password(secret) if secret else '')
+                self.rooms[room.name] = room
+                rooms.append(room)
+            Room.objects.bulk_create(rooms)
+            self.counts['rooms'] += len(rooms)
+
+    def import_members(self, records):
+        Membership = User.rooms.through
+        for batch in batches(records, self.batch_size):
+            user_ids = self.resolve_users([record['username'] for record in batch])
+            memberships = []
+            for record in batch:
+                room = self.room(record['room'])
+                if record['username'] not in self.members[room.id]:
+                    self.members[room.id].add(record['username'])
+                    # touching the entry gives members without payments zero statistics as well
+                    self.statistics[(room.id, user_ids[record['username']])]
+                    memberships.append(Membership(user_id=user_ids[record['username']], room_id=room.id))
+            Membership.objects.bulk_create(memberships)
+            self.counts['members'] += len(memberships)
+
+    def import_payments(self, records):
+        for batch in batches(records, self.batch_size):
+            user_ids = self.resolve_users([r['drawee'] for r in batch] + [r['pledger'] for r in batch])
+            payments = []
+            for record in batch:
+                date = parse_datetime(record['date']) if record.get('date') else timezone.now()
+                if timezone.is_naive(date):
+                    date = timezone.make_aware(date)
+                payment = Payment(
+                    id=uuid.uuid4(),
+                    drawee_id=user_ids[record['drawee']],
+                    pledger_id=user_ids[record['pledger']],
+                    room=self.room(record['room']),
+                    amount=float(record['amount']),
+                    name=record.get('name') or '',
+                    date=date,
+                )
+                self.account(payment)
+                payments.append(payment)
+
+            # `date` is auto_now_add, bulk_create overwrites it, the historical dates are restored
+            # by a single UPDATE per batch
+            dates = [When(id=payment.id, then=payment.date) for payment in payments]
+            Payment.objects.bulk_create(payments)
+            Payment.objects.filter(id__in=[p.id for p in payments]).update(
+                date=Case(*dates, output_field=DateTimeField()))
+            self.counts['payments'] += len(payments)
+
+    def account(self, payment):
+        amount = round(payment.amount, 2)
+        balances = self.balances[payment.room_id]
+        # same bookkeeping as `Optimization.add_payment` followed by summarizing the matrix
+        balances[payment.drawee_id] -= amount
+        balances[payment.pledger_id] += amount
+        self.totals[payment.room_id] += abs(payment.amount)
+
+        self.user_balances[payment.drawee_id] -= Decimal(str(payment.amount))
+        self.user_balances[payment.pledger_id] += Decimal(str(payment.amount))
+
+        drawee_statistics = self.statistics[(payment.room_id, payment.drawee_id)]
+        pledger_statistics = self.statistics[(payment.room_id, payment.pledger_id)]
+        drawee_statistics[0] -= payment.amount
+        pledger_statistics[1] -= payment.amount
+        drawee_statistics[2] += 1
+        if pledger_statistics is not drawee_statistics:
+            pledger_statistics[2] += 1
+
+        day = payment.date.date()
+        for period, start in ((RoomSpending.DAY, day), (RoomSpending.MONTH, day.replace(day=1))):
+            bucket = self.spending[(payment.room_id, period, start)]
+            bucket[0] += abs(payment.amount)
+            bucket[1] += 1
+
+    def finish(self):
+        RoomStatistics.objects.bulk_create(
+            (RoomStatistics(room_id=room_id, user_id=user_id, paid=paid, owed=owed, balance=paid - owed,
+                            payments_count=count)
+             for (room_id, user_id), (paid, owed, count) in self.statistics.items()),
+            batch_size=self.batch_size,
+        )
+        RoomSpending.objects.bulk_create(
+            (RoomSpending(room_id=room_id, period=period, start=start, amount=amount, payments_count=count)
+             for (room_id, period, start), (amount, count) in self.spending.items()),
+            batch_size=self.batch_size,
+        )
+
+        for room in self.rooms.values():
+            balances = {self.user_ids[username]: 0.0 for username in sorted(self.members[room.id])}
+            balances.update(self.balances.get(room.id, {}))
+            op = engine.Optimization(room_id=room.id)
+            if balances:
+                op.create_from_balances(balances)
+                op.run()
+            else:
+                op.create_matrix([])
+            room.matrix = op.export_to_json()
+            room.total_balance = self.totals[room.id]
+            room.biggest_pledger = RoomStatistics.biggest_pledger(room.id)
+            room.save()
+
+        for user_id, change in self.user_balances.items():
+            if change:
+                User.objects.filter(id=user_id).update(balance=F('balance') + change)
+                # the update skips `User.save`
+                forget_user(user_id)
+
+        User.balances_changed(list(self.user_balances))
+        return dict(self.counts)
+
+
+def run(users=(), rooms=(), members=(), payments=(), batch_size=BATCH_SIZE, processes=1):
+    """
+        Import all records in one transaction, returns counts of imported objects
+    """
+    importer = Importer(batch_size=batch_size, processes=processes)
+    with tempfile.TemporaryFile('w+') as staged:
+        # hashing is slow, it is kept out of the transaction
+        importer.prepare_users(users, staged)
+        staged.seek(0)
+        with transaction.atomic():
+            importer.import_users(read_records(staged, 'users.ndjson'))
+            importer.import_rooms(rooms)
+            importer.import_members(members)
+            importer.import_payments(payments)
+            return importer.finish()
@@ -0,0 +1,205 @@
+import heapq
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from functools import partial
+from itertools import groupby
+from multiprocessing import Pool
+from time import perf_counter
+
+from django.db import connections, transaction
+from django.db.models import F
+
+from payments.backends import forget_user
+from payments.models import ArchivedPayment, Payment, Room, RoomSpending, RoomStatistics, User
+from payments.utils import engine, responseCache
+
+CHUNK_SIZE = 2000
+
+
+def shard_bounds(shard, shards):
+    """
+        Slice of the room id space covered by `shard`, rooms are spread evenly by their random UUIDs
+    """
+    low = uuid.UUID(int=shard * 2 ** 128 // shards)
+    high = uuid.UUID(int=(shard + 1) * 2 ** 128 // shards) if shard + 1 < shards else None
+    return low, high
+
+
+def _in_shard(queryset, field, low, high):
+    queryset = queryset.filter(**{field + '__gte': low})
+    return queryset.filter(**{field + '__lt': high}) if high is not None else queryset
+
+
+def _payments(queryset, low, high, chunk_size):
+    return _in_shard(queryset, 'room_id', low, high).order_by('room_id').values_list(
+        'room_id', 'drawee_id', 'pledger_id', 'amount').iterator(chunk_size=chunk_size)
+
+
+def expected_balances(payments):
+    """
+        Balances the room matrix should hold after replaying `(drawee, pledger, amount)` payments
+    """
+    balances = defaultdict(float)
+    for drawee, pledger, amount in payments:
+        # same rounding as `Optimization.add_payment`
+        amount = round(amount, 2)
+        balances[drawee] -= amount
+        balances[pledger] += amount
+    return balances
+
+
+def _by_room(rows):
+    """
+        Join `(room_id, ...)` rows streamed in room id order, `take(room_id)` returns the rest of the rows
+        of the room. Rooms must be taken in ascending order, rows of rooms that are never taken are skipped.
+    """
+    groups = groupby(rows, key=lambda row: str(row[0]))
+    pending = [next(groups, None)]
+
+    def take(key):
+        while pending[0] is not None and pending[0][0] < key:
+            pending[0] = next(groups, None)
+        if pending[0] is None or pending[0][0] != key:
+            return []
+        taken = [row[1:] for row in pending[0][1]]
+        pending[0] = next(groups, None)
+        return taken
+
+    return take
+
+
+def drift(actual, expected):
+    return max((abs(actual.get(user, 0.0) - expected.get(user, 0.0)) for user in set(actual) | set(expected)),
+               default=0.0)
+
+
+def _statistics(payments):
+    """
+        Member statistics and spending buckets of a room replayed from `(drawee, pledger, amount, date)` payments,
+        same accounting as `RoomStatistics.add_payment`
+    """
+    statistics = defaultdict(lambda: {'paid': 0.0, 'owed': 0.0, 'balance': 0.0, 'payments_count': 0})
+    spending = defaultdict(lambda: {'amount': 0.0, 'payments_count': 0})
+    for drawee, pledger, amount, date in payments:
+        value = -amount
+        statistics[drawee]['paid'] += value
+        statistics[drawee]['balance'] += value
+        statistics[drawee]['payments_count'] += 1
+        statistics[pledger]['owed'] += value
+        statistics[pledger]['balance'] -= value
+        if pledger != drawee:
+            statistics[pledger]['payments_count'] += 1
+
+        day = date.date()
+        for period, start in ((RoomSpending.DAY, day), (RoomSpending.MONTH, day.replace(day=1))):
+            spending[(period, start)]['amount'] += abs(amount)
+            spending[(period, start)]['payments_count'] += 1
+    return statistics, spending
+
+
+def repair_room(room_id):
+    """
+        Rebuild the room matrix and everything accounted from its payments (member statistics, spending,
+        total balance, biggest pledger and the balances of its members) from the payment history.
+        The room row is locked meanwhile, so payments can't be accounted twice.
+    """
+    with transaction.atomic():
+        room = Room.objects.select_for_update().get(id=room_id)
+        payments = [
+            row for model in (Payment, ArchivedPayment)
+            for row in model.objects.filter(room_id=room_id).values_list(
+                'drawee_id', 'pledger_id', 'amount', 'date')
+        ]
+        op = engine.Optimization(room_id=room_id)
+        op.load_from_json(room.matrix)
+        balances = {user: 0.0 for user in op.matrix.index}
+        balances.update(expected_balances(row[:3] for row in payments))
+        if balances:
+            op.create_from_balances(balances)
+            op.run()
+        room.matrix = op.export_to_json()
+
+        statistics, spending = _statistics(payments)
+        accounted = dict(RoomStatistics.objects.filter(room_id=room_id).values_list('user_id', 'balance'))
+        members = set(room.user_set.values_list('id', flat=True))
+        # balance of a user is the sum of their balances in all rooms, only the difference in this room is applied
+        changed = []
+        for user_id in set(accounted) | set(statistics):
+            # rounded to the precision of `User.balance`, float noise is not a change
+            difference = round(statistics[user_id]['balance'] - accounted.get(user_id, 0.0), 5)
+            if difference:
+                User.objects.filter(id=user_id).update(balance=F('balance') + Decimal(str(difference)))
+                changed.append(user_id)
+
+        RoomStatistics.objects.filter(room_id=room_id).delete()
+        RoomStatistics.objects.bulk_create(
+            RoomStatistics(room_id=room_id, user_id=user_id, **statistics[user_id])
+            for user_id in members | set(statistics))
+        RoomSpending.objects.filter(room_id=room_id).delete()
+        RoomSpending.objects.bulk_create(
+            RoomSpending(room_id=room_id, period=period, start=start, **totals)
+            for (period, start), totals in spending.items())
+
+        room.total_balance = sum(abs(row[2]) for row in payments)
+        room.biggest_pledger = RoomStatistics.biggest_pledger(room_id)
+        room.save()
+
+        for user_id in changed:
+            transaction.on_commit(partial(forget_user, user_id))
+        User.balances_changed(changed)
+    responseCache.invalidate(room_id)
+
+
+def verify_shard(shard, shards, repair=False, tolerance=0.01, chunk_size=CHUNK_SIZE):
+    """
+        Compare matrices and member statistics of the rooms in `shard` with their payment history.
+        Rooms, payments and statistics are streamed in room id order and joined on the fly, one room is in memory
+        at a time.
+    """
+    started = perf_counter()
+    low, high = shard_bounds(shard, shards)
+    rooms = _in_shard(Room.objects.all(), 'id', low, high).order_by('id').values_list('id', 'matrix').iterator(
+        chunk_size=chunk_size)
+    payments = heapq.merge(
+        _payments(Payment.objects.all(), low, high, chunk_size),
+        _payments(ArchivedPayment.objects.all(), low, high, chunk_size),
+        key=lambda row: str(row[0]),
+    )
+    # payments of a room missing from the room stream, e.g. created meanwhile, are skipped
+    history = _by_room(payments)
+    statistics = _by_room(_in_shard(RoomStatistics.objects.all(), 'room_id', low, high).order_by('room_id')
+                          .values_list('room_id', 'user_id', 'balance').iterator(chunk_size=chunk_size))
+
+    op = engine.Optimization()
+    stats = {'shard': shard, 'rooms': 0, 'payments': 0, 'drifted': [], 'repaired': 0}
+    for id, matrix in rooms:
+        key = str(id)
+        rows = history(key)
+        expected = expected_balances(rows)
+
+        op.load_from_json(matrix)
+        difference = max(drift(op.get_balances(), expected), drift(dict(statistics(key)), expected))
+        if difference > tolerance:
+            stats['drifted'].append((str(id), difference))
+            if repair:
+                repair_room(id)
+                stats['repaired'] += 1
+        stats['rooms'] += 1
+        stats['payments'] += len(rows)
+
+    stats['seconds'] = perf_counter() - started
+    return stats
+
+
+def verify(shards=1, processes=1, **kwargs):
+    """
+        Verify all rooms, shards are processed by a pool of `processes` workers
+    """
+    if processes <= 1:
+        return [verify_shard(shard, shards, **kwargs) for shard in range(shards)]
+
+    # forked workers must not share the parent's database connections
+    connections.close_all()
+    with Pool(processes) as pool:
+        return pool.map(partial(verify_shard, shards=shards, **kwargs), range(shards))
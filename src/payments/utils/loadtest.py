@@ -0,0 +1,250 @@
+import json
+import math
+import random
+import re
+import threading
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from time import perf_counter
+
+OPERATIONS = {
+    'tokenAuth': """
+        mutation TokenAuth($username: String!, $password: String!) {
+            tokenAuth(username: $username, password: $password) { token }
+        }""",
+    'makePayment': """
+        mutation MakePayment($drawee: String!, $pledger: String!, $roomId: String!, $amount: Float!, $name: String!) {
+            makePayment(drawee: $drawee, pledger: $pledger, roomId: $roomId, amount: $amount, name: $name) {
+                payment { id }
+            }
+        }""",
+    'room': """
+        query Room($roomId: String) {
+            room(roomId: $roomId) { name matrix totalBalance biggestPledger }
+        }""",
+    'getPayments': """
+        query GetPayments($roomId: String) {
+            getPayments(roomId: $roomId) { id name amount date drawee { username } pledger { username } }
+        }""",
+    'addUserToRoom': """
+        mutation AddUserToRoom($roomId: String!, $username: String!) {
+            addUserToRoom(roomId: $roomId, username: $username) { user { id } }
+        }""",
+}
+
+# operation weights, `hot_room` is the share of traffic sent to the first room
+PROFILES = {
+    'read-heavy': {
+        'weights': {'tokenAuth': 2, 'makePayment': 8, 'room': 50, 'getPayments': 38, 'addUserToRoom': 2},
+        'hot_room': 0.0,
+    },
+    'mixed': {
+        'weights': {'tokenAuth': 5, 'makePayment': 30, 'room': 35, 'getPayments': 25, 'addUserToRoom': 5},
+        'hot_room': 0.0,
+    },
+    'hot-room': {
+        'weights': {'tokenAuth': 2, 'makePayment': 48, 'room': 30, 'getPayments': 18, 'addUserToRoom': 2},
+        'hot_room': 0.9,
+    },
+}
+
+SQL_QUERIES = re.compile(r'^fannypack_operation_sql_queries_total\{operation="(\w+)"\} (\S+)$', re.M)
+OPERATION_COUNT = re.compile(r'^fannypack_operation_seconds_count\{operation="(\w+)"\} (\S+)$', re.M)
+
+
+def operation_name(operation):
+    return operation[0].upper() + operation[1:]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def parse_metrics(text):
+    """
+        Return `{operation: (sql queries, sampled operations)}` from the server's /metrics/ output
+    """
+    queries = {name: float(value) for name, value in SQL_QUERIES.findall(text)}
+    counts = {name: float(value) for name, value in OPERATION_COUNT.findall(text)}
+    return {name: (queries.get(name, 0.0), counts[name]) for name in counts}
+
+
+class LoadTest:
+    """
+        Drive a running server with `concurrency` threads for `duration` seconds.
+            - `rooms` is a list of `{'id': ..., 'members': [...]}`, all members share `password`
+            - `spare_users` are consumed by `addUserToRoom`, once they run out the operation is skipped
+    """
+
+    def __init__(self, url, rooms, password, spare_users=(), profile='mixed', concurrency=8, duration=30, seed=0,
+                 metrics_token=None):
+        self.url = url
+        self.metrics_token = metrics_token
+        self.rooms = rooms
+        self.password = password
+        self.spare_users = list(spare_users)
+        self.profile = PROFILES[profile]
+        self.profile_name = profile
+        self.concurrency = concurrency
+        self.duration = duration
+        self.seed = seed
+        self.tokens = {}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        self.warnings = []
+
+    def post(self, operation, variables, token=None):
+        body = json.dumps({'query': OPERATIONS[operation], 'variables': variables, 'operationName': operation_name(operation)})
+        request = urllib.request.Request(self.url, data=body.encode(), headers={'Content-Type': 'application/json'})
+        if token:
+            request.add_header('Authorization', 'JWT ' + token)
+
+        started = perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                content = json.loads(response.read().decode())
+            ok = not content.get('errors')
+        except (urllib.error.URLError, ValueError):
+            content, ok = None, False
+        elapsed = perf_counter() - started
+
+        with self.lock:
+            self.latencies[operation].append(elapsed)
+            if not ok:
+                self.errors[operation] += 1
+        return content if ok else None
+
+    def authenticate(self, username):
+        content = self.post('tokenAuth', {'username': username, 'password': self.password})
+        if content is not None:
+            self.tokens[username] = content['data']['tokenAuth']['token']
+        return self.tokens.get(username)
+
+    def pick_room(self, rng):
+        if rng.random() < self.profile['hot_room']:
+            return self.rooms[0]
+        return rng.choice(self.rooms)
+
+    def step(self, rng):
+        operations, weights = zip(*self.profile['weights'].items())
+        operation = rng.choices(operations, weights)[0]
+        room = self.pick_room(rng)
+        username = rng.choice(room['members'])
+        token = self.tokens.get(username) or self.authenticate(username)
+
+        if operation == 'tokenAuth':
+            self.authenticate(username)
+        elif operation == 'makePayment':
+            self.post('makePayment', {
+                'drawee': username,
+                'pledger': rng.choice(room['members']),
+                'roomId': room['id'],
+                'amount': -round(rng.lognormvariate(3, 1), 2),
+                'name': 'load test',
+            }, token)
+        elif operation == 'addUserToRoom':
+            with self.lock:
+                spare = self.spare_users.pop() if self.spare_users else None
+            if spare is not None:
+                self.post('addUserToRoom', {'roomId': room['id'], 'username': spare}, token)
+        else:
+            self.post(operation, {'roomId': room['id']}, token)
+
+    def worker(self, index, deadline):
+        rng = random.Random(self.seed * 1000 + index)
+        while perf_counter() < deadline:
+            self.step(rng)
+
+    def metrics(self):
+        url = self.url.rstrip('/').rsplit('/', 1)[0] + '/metrics/'
+        request = urllib.request.Request(url)
+        if self.metrics_token:
+            request.add_header('Authorization', 'Bearer ' + self.metrics_token)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return parse_metrics(response.read().decode())
+        except (urllib.error.URLError, ValueError) as e:
+            # without metrics the report has no SQL queries per operation
+            self.warnings.append('Scraping {} failed: {}'.format(url, e))
+            return {}
+
+    def run(self):
+        before = self.metrics()
+        started = perf_counter()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline)) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - started
+        after = self.metrics()
+
+        return self.report(elapsed, before, after)
+
+    def report(self, elapsed, before, after):
+        operations = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            name = operation_name(operation)
+            queries = None
+            if name in after:
+                sampled = after[name][1] - before.get(name, (0.0, 0.0))[1]
+                if sampled:
+                    queries = (after[name][0] - before.get(name, (0.0, 0.0))[0]) / sampled
+
+            operations[operation] = {
+                'requests': len(latencies),
+                'errors': self.errors[operation],
+                'error_rate': self.errors[operation] / len(latencies),
+                'throughput': len(latencies) / elapsed,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'sql_queries': queries,
+            }
+
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        errors = sum(self.errors.values())
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {
+            'meta': {
+                'profile': self.profile_name,
+                'concurrency': self.concurrency,
+                'duration': self.duration,
+                'seed': self.seed,
+                'rooms': len(self.rooms),
+                'members': sum(len(room['members']) for room in self.rooms),
+            },
+            'total': {
+                'requests': requests,
+                'errors': errors,
+                'error_rate': errors / requests if requests else 0.0,
+                'throughput': requests / elapsed,
+                'p50': percentile(all_latencies, 50),
+                'p95': percentile(all_latencies, 95),
+                'p99': percentile(all_latencies, 99),
+            },
+            'operations': operations,
+            'warnings': self.warnings,
+        }
+
+
+def compare(baseline, current):
+    """
+        Return `(operation, metric, before, after)` rows for throughput, p95 and error rate
+    """
+    rows = []
+    sections = [('total', baseline['total'], current['total'])]
+    sections += [(name, baseline['operations'].get(name), stats) for name, stats in current['operations'].items()]
+    for name, before, after in sections:
+        if not before:
+            continue
+        for metric in ('throughput', 'p95', 'error_rate'):
+            rows.append((name, metric, before[metric], after[metric]))
+    return rows
@@ -0,0 +1,41 @@
+import json
+
+NESTED = 'nested'
+DENSE = 'dense'
+SPARSE = 'sparse'
+ENCODINGS = (NESTED, DENSE, SPARSE)
+
+
+def encode(matrix, encoding=NESTED, names=None):
+    """
+        Re-encode a room matrix stored as `{column: {row: value}}` JSON without loading it into pandas.
+            - `dense`: `{"users": [...], "values": [...]}`, values row by row, `users` label rows and columns
+            - `sparse`: `{"users": [...], "cells": [[row, column, value], ...]}` for non-zero values only
+        `names` maps the stored user ids to labels, e.g. `User.usernames`, ids are kept when omitted.
+        `matrix` may be given already parsed.
+    """
+    if encoding not in ENCODINGS:
+        raise Exception('Unknown matrix encoding {}'.format(encoding))
+    if encoding == NESTED and names is None and isinstance(matrix, str):
+        return matrix
+
+    columns = json.loads(matrix) if isinstance(matrix, str) else matrix
+    if names is not None:
+        labels = names(list(columns))
+        columns = {labels[column]: {labels[row]: value for row, value in rows.items()}
+                   for column, rows in columns.items()}
+    if encoding == NESTED:
+        return json.dumps(columns, separators=(',', ':'))
+
+    users = list(columns)
+    if encoding == DENSE:
+        values = [columns[column].get(row, 0.0) for row in users for column in users]
+        return json.dumps({'users': users, 'values': values}, separators=(',', ':'))
+
+    positions = {user: index for index, user in enumerate(users)}
+    cells = [
+        [positions[row], positions[column], value]
+        for column in users for row, value in columns[column].items() if value
+    ]
+    cells.sort()
+    return json.dumps({'users': users, 'cells': cells}, separators=(',', ':'))
@@ -1,6 +1,11 @@
+from time import perf_counter
+
 import pandas as pd
 import numpy as np
 
+from payments.instrumentation import timed
+from payments.utils import engineTrace
+
 
 class Optimization:
     """
@@ -9,11 +14,18 @@ class Optimization:
                 - create empty transaction matrix by calling `Optimization.create_matrix(self, users)` method,
                   where parameter users is array of strings of users specifiers(e.g. 'id' or 'unique name')
                 - load matrix from JSON with method `Optimization.load_from_json(json)
+                - or start from net balances of users with `Optimization.create_from_balances(balances)`
             - Payment can be added by calling method `Optimization.add_payment(drawee,pledger,amount)`
+            - Rooms key their matrices by user id, `load_from_json` turns the JSON keys back into integers
             - When matrix is ready, call `Optimization.run()` to get optimized matrix
+            - `room_id` only labels the traces emitted by `run()`, see `payments.utils.engineTrace`
     """
 
     matrix = []
+    iterations = 0
+
+    def __init__(self, room_id=None):
+        self.room_id = room_id
 
 # -------------------- DATA SOURCES ------------------------ #
 
@@ -30,11 +42,34 @@ class Optimization:
 
         return self.matrix
 
+    def create_from_balances(self, balances: {str: float}) -> matrix:
+        """
+            Build the summarized form directly, balance of every user on the diagonal
+        """
+        users = list(balances)
+        self.matrix = pd.DataFrame(
+            data=np.diag(np.array([round(balances[user], 2) for user in users], dtype=float)),
+            index=users,
+            columns=users)
+
+        return self.matrix
+
     def export_to_json(self) -> str:
         return self.matrix.to_json()
 
     def load_from_json(self, json: str):
-        self.matrix = pd.read_json(json)
+        # axes are not converted by pandas, large ids would be taken for timestamps
+        matrix = pd.read_json(json, convert_axes=False)
+        matrix.index = self._labels(matrix.index)
+        matrix.columns = self._labels(matrix.columns)
+        self.matrix = matrix
+
+    @staticmethod
+    def _labels(labels):
+        # user ids are written as strings of digits, other labels stay strings
+        if len(labels) and all(str(label).isdigit() for label in labels):
+            return labels.astype(int)
+        return labels
 
 # -------------------- Optimization algorithms ------------------------ #
     def summarize_matrix(self) -> []:
@@ -55,11 +90,12 @@ class Optimization:
 
         self.matrix = df
 
-        print("SUMMARIZED MATRIX _____________________\n", self.matrix)
+        engineTrace.dump_matrix(self.room_id, 'summarized', self.matrix)
 
         return self.matrix.copy().values
 
     def optimize(self, summarized_matrix):
+        self.iterations += 1
         max_index_x = -1
         max_index_y = -1
         min_index_x = -1
@@ -109,58 +145,61 @@ class Optimization:
         self.optimize(summarized_matrix)
 
     # ----------------------- Getters ---------------------------------#
-    def get_biggest_pledger(self):
-        indexes = self.matrix.index
-        no_users = len(indexes)
-
-        summarized_matrix = np.zeros((no_users, no_users), dtype=float)
-
-        for i in range(len(indexes)):
-            summarized_matrix[i][i] = self.matrix[indexes[i]].sum()
+    def get_balances(self) -> {str: float}:
+        # balance of every user is the sum of their column
+        return {user: round(balance, 2) for user, balance in self.matrix.sum().items()}
 
-        df = pd.DataFrame(
-            data=summarized_matrix,
-            index=indexes,
-            columns=indexes)
-
-        min_index_x = -1
-        min_v = 0
-
-        for row in range(len(summarized_matrix[0])):
-            for col in range(len(summarized_matrix[1])):
-                if min_v > summarized_matrix[row][col]:
-                    min_v = summarized_matrix[row][col]
-                    min_index_x = row
-
-        out = df.columns.values[min_index_x]
-        return out
+    def get_biggest_pledger(self):
+        balances = self.matrix.sum()
+        if balances.min() < 0:
+            return balances.idxmin()
+        return self.matrix.columns.values[-1]
+
+    def get_transfers(self) -> [(str, str, float)]:
+        """
+            Transfers of the optimized matrix as `(debtor, creditor, amount)` triples
+        """
+        values = self.matrix.values
+        transfers = []
+        for row, col in zip(*np.nonzero(values < 0)):
+            if row != col:
+                transfers.append((self.matrix.columns[col], self.matrix.index[row], round(-values[row, col], 2)))
+        return transfers
 
     # -------------------- Management Methods ------------------------ #
-    def add_payment(self, drawee: str, pledger: str, amount: float):
-        indexes = self.matrix.index
-        if str(drawee) not in indexes:
-            self.add_user(str(drawee))
-            indexes = self.matrix.index
-        if str(pledger) not in indexes:
-            self.add_user(str(pledger))
+    def add_payment(self, drawee, pledger, amount: float):
+        missing = [user for user in (drawee, pledger) if user not in self.matrix.index]
+        if missing:
+            self.add_users(missing)
 
         amount = round(amount, 2)
 
-        self.matrix.loc[str(drawee), str(pledger)] += amount
-        self.matrix.loc[str(drawee), str(drawee)] += -amount
+        self.matrix.loc[drawee, pledger] += amount
+        self.matrix.loc[drawee, drawee] += -amount
 
     def add_user(self, name):
-        index = [name]
-        init_matrix = np.zeros(1, dtype=float)
-        df = pd.DataFrame(
-            data=init_matrix,
-            index=index,
-            columns=index)
-
-        result = pd.concat([self.matrix, df], axis=1, sort=False)
-        self.matrix = result.fillna(value=0)
-
+        self.add_users([name])
+
+    def add_users(self, names: [str]):
+        # one reindex for all new users instead of a concat per user, known users are skipped
+        users = list(self.matrix.index)
+        known = set(users)
+        for name in names:
+            if name not in known:
+                users.append(name)
+                known.add(name)
+        self.matrix = self.matrix.reindex(index=users, columns=users, fill_value=0.0).astype(float)
+
+    @timed('optimization_run')
     def run(self) -> matrix:
+        tracing = engineTrace.should_trace()
+        started = perf_counter()
+        self.iterations = 0
+
         summarized_m = self.summarize_matrix()
         self.optimize(summarized_m)
+
+        if tracing:
+            engineTrace.emit_run(self.room_id, self.matrix, self.iterations, perf_counter() - started)
+        engineTrace.dump_matrix(self.room_id, 'optimized', self.matrix)
         return self.matrix
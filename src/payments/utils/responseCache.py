@@ -0,0 +1,175 @@
+import hashlib
+import json
+import time
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from graphql import parse
+from graphql.language.ast import Field, FragmentSpread, OperationDefinition, Variable
+
+GLOBAL_VERSION_KEY = 'ledger-version'
+ROOM_VERSION_KEY = 'room-version:{}'
+USER_VERSION_KEY = 'user-version:{}'
+RESPONSE_KEY = 'graphql-response:{}'
+# time a version key was last bumped
+CHANGED_KEY = 'changed:{}'
+ROOM_VARIABLES = ('roomId', 'room_id')
+# fields listing rooms other than the one of the root field
+ROOMS_FIELDS = ('rooms', 'getRooms')
+
+
+def _room_key(room_id):
+    try:
+        room_id = uuid.UUID(str(room_id))
+    except ValueError:
+        pass
+    return ROOM_VERSION_KEY.format(room_id)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_versions(keys):
+    versions = {key: uuid.uuid4().hex for key in keys}
+    changed = time.time()
+    versions.update((CHANGED_KEY.format(key), changed) for key in keys)
+    cache.set_many(versions, None)
+
+
+def changed_within(keys, seconds):
+    """
+        Whether any of the version `keys` was bumped in the last `seconds`, replicas may not have caught up yet
+    """
+    changed = cache.get_many([CHANGED_KEY.format(key) for key in keys]).values()
+    return any(time.time() - timestamp < seconds for timestamp in changed)
+
+
+def _invalidate(keys):
+    _bump_versions(keys)
+    transaction.on_commit(lambda: _bump_versions(keys))
+
+
+def room_version(room_id):
+    return _get_version(_room_key(room_id))
+
+
+def global_version():
+    return _get_version(GLOBAL_VERSION_KEY)
+
+
+def user_version(user_id):
+    return _get_version(USER_VERSION_KEY.format(user_id))
+
+
+def invalidate(room_id=None):
+    """
+        Drop every cached response that depends on room `room_id` (or on any room when omitted).
+        Versions are bumped immediately and once more after commit, so a read racing the open
+        transaction cannot pin stale data under the new version.
+    """
+    keys = [GLOBAL_VERSION_KEY]
+    if room_id is not None:
+        keys.append(_room_key(room_id))
+    _invalidate(keys)
+
+
+def invalidate_users(user_ids, room_ids):
+    """
+        Drop cached responses showing the balance of the users: responses of their rooms `room_ids`,
+        of the users themselves (`me`) and responses not bound to a room
+    """
+    _invalidate([GLOBAL_VERSION_KEY] + [USER_VERSION_KEY.format(id) for id in user_ids] +
+                [_room_key(room_id) for room_id in room_ids])
+
+
+def _operation(query, operation_name):
+    try:
+        document = parse(query)
+    except Exception:
+        return None
+
+    operations = [d for d in document.definitions if isinstance(d, OperationDefinition)]
+    if operation_name:
+        operations = [o for o in operations if o.name and o.name.value == operation_name]
+    return operations[0] if len(operations) == 1 else None
+
+
+@lru_cache(maxsize=256)
+def is_read_only(query, operation_name=None):
+    operation = _operation(query, operation_name)
+    return operation is not None and operation.operation == 'query'
+
+
+def _lists_rooms(selection_set):
+    for selection in selection_set.selections if selection_set else ():
+        # fragments are not followed, they may list rooms
+        if isinstance(selection, FragmentSpread):
+            return True
+        if isinstance(selection, Field) and selection.name.value in ROOMS_FIELDS:
+            return True
+        if _lists_rooms(selection.selection_set):
+            return True
+    return False
+
+
+@lru_cache(maxsize=256)
+def is_room_scoped(query, operation_name, variable):
+    """
+        Whether the operation reads only the room passed in `variable`: every root field takes the variable
+        as its room argument and nothing below lists other rooms
+    """
+    operation = _operation(query, operation_name)
+    if operation is None:
+        return False
+    for selection in operation.selection_set.selections:
+        if isinstance(selection, Field) and selection.name.value == '__typename':
+            continue
+        if not isinstance(selection, Field) or _lists_rooms(selection.selection_set):
+            return False
+        if not any(argument.name.value in ROOM_VARIABLES and isinstance(argument.value, Variable) and
+                   argument.value.name.value == variable for argument in selection.arguments):
+            return False
+    return True
+
+
+def dependencies(query, variables, operation_name, user_id=None):
+    """
+        Version keys a response of the operation depends on: the room of the `roomId` variable when the operation
+        reads only that room, the global version otherwise, and the version of the caller
+    """
+    variables = variables or {}
+    variable = next((name for name in ROOM_VARIABLES if variables.get(name)), None)
+    keys = []
+    if variable is not None:
+        keys.append(_room_key(variables[variable]))
+    if variable is None or not is_room_scoped(query, operation_name, variable):
+        keys.append(GLOBAL_VERSION_KEY)
+    if user_id is not None:
+        # the balance of the caller changes with payments of rooms other than `roomId`
+        keys.append(USER_VERSION_KEY.format(user_id))
+    return keys
+
+
+def get_cache_key(query, variables, operation_name, identity, user_id=None):
+    versions = [_get_version(key) for key in dependencies(query, variables, operation_name, user_id)]
+
+    raw = json.dumps([query, variables or {}, operation_name, identity, versions], sort_keys=True)
+    return RESPONSE_KEY.format(hashlib.sha256(raw.encode()).hexdigest())
+
+
+def get_response(key):
+    return cache.get(key)
+
+
+def set_response(key, content):
+    etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+    cache.set(key, (etag, content), settings.GRAPHQL_RESPONSE_CACHE_TIMEOUT)
+    return etag
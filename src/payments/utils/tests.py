@@ -1,5 +1,9 @@
 import json
-from unittest import TestCase
+import time
+import urllib.error
+from unittest import TestCase, mock
+
+from payments.utils import benchmark, loadtest
 from payments.utils.optimization import Optimization
 
 
@@ -41,6 +45,11 @@ class TestOptimization(TestCase):
         expected_matrix = {'t1': {'t1': 0.0, 't2': 0.0}, 't2': {'t1': 0.0, 't2': 0.0}}
         self.assertEqual(op.matrix.to_dict(), expected_matrix)
 
+    def test_add_users(self):
+        self.op.add_users(['t2', 't3', 't4'])
+        expected_matrix = {user: {'t1': 0.0, 't2': 0.0, 't3': 0.0, 't4': 0.0} for user in ('t1', 't2', 't3', 't4')}
+        self.assertEqual(self.op.matrix.to_dict(), expected_matrix)
+
     def test_add_payment_known_user(self):
         self.op.add_payment('t1', 't2', -100)
         expected_matrix = {'t1': {'t1': 100.0, 't2': 0.0}, 't2': {'t1': -100.0, 't2': 0.0}}
@@ -169,6 +178,11 @@ class TestOptimization(TestCase):
         pledger = self.op.get_biggest_pledger()
         self.assertEqual(pledger, 't2')
 
+    def test_transfers_from_balances(self):
+        self.op.create_from_balances({'t1': -80, 't2': -410, 't3': 490})
+        self.op.run()
+        self.assertEqual(self.op.get_transfers(), [('t1', 't3', 80.0), ('t2', 't3', 410.0)])
+
     def test_simple_float_point_operations(self):
 
         self.op.add_payment(drawee='t1', pledger='t2', amount=-33.33333)
@@ -201,3 +215,57 @@ class TestOptimization(TestCase):
         stringified = self.op.export_to_json()
         dict = json.loads(stringified)
         self.assertEqual(dict, expected_matrix)
+
+
+class TestBenchmark(TestCase):
+
+    def test_synthetic_payments_are_reproducible(self):
+        users = ['t1', 't2', 't3', 't4']
+        first = list(benchmark.synthetic_payments(users, 3, seed=1))
+        second = list(benchmark.synthetic_payments(users, 3, seed=1))
+        self.assertEqual(first, second)
+        self.assertTrue(all(drawee != pledger and amount <= 0 for drawee, pledger, amount in first))
+
+    def test_run_and_compare(self):
+        results = benchmark.run_benchmark([2, 5], payments_per_user=2, repeat=1, limits={'run': 2})
+        self.assertEqual(set(results['results']), {'2', '5'})
+        self.assertIn('seconds', results['results']['2']['run'])
+        self.assertIn('skipped', results['results']['5']['run'])
+
+        rows = benchmark.compare(results, results)
+        self.assertTrue(rows)
+        self.assertFalse(any(regressed for *_, regressed in rows))
+
+    def test_not_measurable(self):
+        with mock.patch.object(Optimization, 'run', side_effect=RecursionError):
+            results = benchmark.run_benchmark([2], repeat=1, operations=['run'])
+        self.assertIn('recursion', results['results']['2']['run']['not measurable'])
+
+        with mock.patch.object(Optimization, 'run', side_effect=lambda: time.sleep(1)):
+            results = benchmark.run_benchmark([2], repeat=1, operations=['run'], timeout=0.05)
+        self.assertEqual(results['results']['2']['run'], {'not measurable': 'slower than 0.05s'})
+
+
+class TestLoadTest(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_metrics_authenticated(self):
+        test = loadtest.LoadTest('http://localhost:1/graphql/', [], 'password', metrics_token='secret')
+        with mock.patch('urllib.request.urlopen', side_effect=urllib.error.HTTPError(
+                'http://localhost:1/metrics/', 403, 'Forbidden', {}, None)) as urlopen:
+            self.assertEqual(test.metrics(), {})
+
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.full_url, 'http://localhost:1/metrics/')
+        self.assertEqual(request.get_header('Authorization'), 'Bearer secret')
+        self.assertEqual(test.warnings, ['Scraping http://localhost:1/metrics/ failed: HTTP Error 403: Forbidden'])
+
+    def test_parse_metrics(self):
+        text = ('fannypack_operation_seconds_count{operation="Room"} 4.0\n'
+                'fannypack_operation_sql_queries_total{operation="Room"} 6.0\n')
+        self.assertEqual(loadtest.parse_metrics(text), {'Room': (6.0, 4.0)})
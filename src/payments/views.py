@@ -1,3 +1,196 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse,
+                         StreamingHttpResponse)
+from django.utils.cache import parse_etags, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.text import compress_string
+from graphene_django.views import GraphQLView as BaseGraphQLView, HttpError
 
-# Create your views here.
+from payments import instrumentation, routers
+from payments.executor import PoolExecutor
+from payments.models import Room
+from payments.utils import export, responseCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def _accepted_encodings(header):
+    encodings = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip().partition('q=')[2]
+        try:
+            if quality and float(quality) <= 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def compress(request, response):
+    """
+        Brotli (when installed) or gzip encode responses of at least `GRAPHQL_COMPRESSION_MIN_BYTES`
+    """
+    threshold = settings.GRAPHQL_COMPRESSION_MIN_BYTES
+    if not threshold or response.streaming or response.has_header('Content-Encoding'):
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(response.content) < threshold:
+        return response
+
+    accepted = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if brotli is not None and 'br' in accepted:
+        encoding, content = 'br', brotli.compress(response.content, quality=5)
+    elif 'gzip' in accepted:
+        encoding, content = 'gzip', compress_string(response.content)
+    else:
+        return response
+    if len(content) >= len(response.content):
+        return response
+
+    response.content = content
+    response['Content-Length'] = str(len(content))
+    response['Content-Encoding'] = encoding
+    if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+        # the encoded body differs byte for byte, as in Django's GZipMiddleware
+        response['ETag'] = 'W/' + response['ETag']
+    return response
+
+
+class GraphQLView(BaseGraphQLView):
+    """
+        GraphQL endpoint which caches read-only operations.
+            - responses are keyed by operation, variables, caller and room version
+            - repeated requests carrying a matching `If-None-Match` get 304 without touching the database
+            - rooms are invalidated from the model methods that mutate them, see `responseCache.invalidate`
+        Sampled requests are traced, see `payments.instrumentation`.
+        Read-only operations read from a replica, see `payments.routers`.
+        Large responses are compressed, see `compress`.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with instrumentation.trace_request() as trace:
+            request.graphql_trace = trace
+            return compress(request, self.dispatch_cached(request, *args, **kwargs))
+
+    def dispatch_cached(self, request, *args, **kwargs):
+        try:
+            key = self.get_cache_key(request)
+        except HttpError:
+            key = None
+
+        if key is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if getattr(request, 'graphql_mutation', False):
+                responseCache.invalidate()
+            return response
+
+        cached = responseCache.get_response(key)
+        if cached is not None:
+            etag, content = cached
+            if_none_match = [_strip_weak(e) for e in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+            if etag in if_none_match or '*' in if_none_match:
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(content=content, content_type="application/json")
+            response['ETag'] = etag
+            return response
+
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and getattr(request, 'graphql_cacheable', False):
+            response['ETag'] = responseCache.set_response(key, response.content)
+        return response
+
+    def get_cache_key(self, request):
+        if not settings.GRAPHQL_RESPONSE_CACHE_TIMEOUT or self.batch:
+            return None
+        if self.graphiql and self.request_wants_html(request):
+            return None
+
+        identity = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not identity:
+            return None
+
+        trace = getattr(request, 'graphql_trace', None)
+        if trace is not None and trace.extensions:
+            return None
+
+        data = self.parse_body(request)
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+        if trace is not None:
+            trace.operation = instrumentation.operation_label(operation_name)
+        if not query or not responseCache.is_read_only(query, operation_name):
+            return None
+
+        user_id = request.user.pk if request.user.is_authenticated else None
+        return responseCache.get_cache_key(query, variables, operation_name, identity, user_id)
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        trace = getattr(request, 'graphql_trace', None)
+        if trace is not None:
+            trace.operation = instrumentation.operation_label(operation_name)
+        read_only = bool(query) and responseCache.is_read_only(query, operation_name)
+        user_id = request.user.pk if request.user.is_authenticated else None
+        # independent root fields of queries are resolved concurrently, mutations stay serial
+        self.executor = PoolExecutor() if read_only and settings.GRAPHQL_EXECUTOR_THREADS else None
+        replica = read_only and bool(settings.DATABASE_REPLICAS) and not routers.is_pinned(user_id)
+        with routers.read_from_replica(replica):
+            result = super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+        request.graphql_mutation = bool(query) and not read_only
+        if request.graphql_mutation:
+            routers.pin_primary(user_id)
+        request.graphql_cacheable = result is not None and not result.errors and not result.invalid
+        if replica and request.graphql_cacheable and responseCache.changed_within(
+                responseCache.dependencies(query, variables, operation_name, user_id), settings.REPLICA_STICKY_SECONDS):
+            # a lagging replica may miss a change the response depends on, it must not be cached under the new version
+            request.graphql_cacheable = False
+        return result
+
+    def json_encode(self, request, d, pretty=False):
+        trace = getattr(request, 'graphql_trace', None)
+        if trace is not None and trace.extensions:
+            trace.duration = trace.elapsed()
+            d['extensions'] = {'timing': trace.as_extension()}
+        return super().json_encode(request, d, pretty)
+
+
+def metrics(request):
+    """
+        Prometheus text format, for staff users or requests with `Authorization: Bearer <METRICS_TOKEN>`
+    """
+    token = settings.METRICS_TOKEN
+    if not (token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)):
+        if not (request.user.is_authenticated and request.user.is_staff):
+            return HttpResponseForbidden()
+    return HttpResponse(instrumentation.registry.render(), content_type='text/plain; version=0.0.4')
+
+
+def export_room(request, room_id, table):
+    """
+        Stream `payments`, `archive` or `balances` of a room as `?format=csv` (default), `ndjson` or `arrow`
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'errors': [{'message': 'Not logged in!'}]}, status=401)
+    format = request.GET.get('format', 'csv')
+    if table not in export.TABLES or format not in export.FORMATS:
+        raise Http404
+    if not Room.objects.filter(id=room_id).exists():
+        raise Http404
+
+    try:
+        content = export.export(room_id, table, format)
+    except Exception as e:
+        return JsonResponse({'errors': [{'message': str(e)}]}, status=400)
+
+    content_type, extension = export.FORMATS[format]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}-{}.{}"'.format(room_id, table, extension)
+    return response